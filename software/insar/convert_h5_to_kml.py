@@ -1,13 +1,27 @@
+import argparse
+import glob
 import h5py
+import hashlib
+import io
+import itertools
 import os
 import pyproj
-import rasterio
+import tempfile
 
+import matplotlib.pyplot as plt
 import numpy as np
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from functools import partial
+
 from pyproj import CRS
 from rasterio import open,Affine
-from rasterio.warp import reproject, Resampling, calculate_default_transform
+from rasterio.shutil import copy as rio_copy
+from rasterio.transform import array_bounds
+from rasterio.warp import Resampling, calculate_default_transform
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import Window
+from zipfile import ZipFile
 
 
 DEFAULT_DICT = {
@@ -26,58 +40,100 @@ DEFAULT_DICT = {
 }
 
 
-def read_h5(fname):
-    with h5py.File(fname, 'r') as f:
-        vel = f['velocity'][()]
-        width = int(f.attrs['WIDTH'])
-        try:
-           hgt = int(f.attrs['FILE_LENGTH'])
-        except:
-           hgt = int(f.attrs['LENGTH'])
-        R = f.attrs['EARTH_RADIUS']
-        ndv = f.attrs['NO_DATA_VALUE']
-        xstep = f.attrs['X_STEP']
-        ystep = f.attrs['Y_STEP']        
-        xf = float(f.attrs['X_FIRST'])
-        yf = float(f.attrs['Y_FIRST'])
-        try:
-            crs = f.attrs['EPSG']
-        except:
-            crs = CRS.from_epsg(4326)
-
-    profile = DEFAULT_DICT
+def read_profile(f, dataset='velocity'):
+    '''Build a rasterio profile for a dataset of an open MintPy HDF5 file'''
+    ds = f[dataset]
+    width = int(f.attrs['WIDTH'])
+    try:
+       hgt = int(f.attrs['FILE_LENGTH'])
+    except:
+       hgt = int(f.attrs['LENGTH'])
+    ndv = f.attrs['NO_DATA_VALUE']
+    xstep = f.attrs['X_STEP']
+    ystep = f.attrs['Y_STEP']        
+    xf = float(f.attrs['X_FIRST'])
+    yf = float(f.attrs['Y_FIRST'])
+    try:
+        crs = f.attrs['EPSG']
+    except:
+        crs = CRS.from_epsg(4326)
+
+    profile = DEFAULT_DICT.copy()
     try:
        profile['nodata'] = float(ndv)
     except:
        profile['nodata'] = -9999
     profile['width'] = width
     profile['height'] = hgt
+    profile['count'] = 1 if ds.ndim == 2 else ds.shape[0]
     profile['crs'] = CRS.from_user_input(crs)
-    profile['dtype'] = vel[0,0].dtype
+    profile['dtype'] = ds.dtype
+    if ds.dtype == bool:
+        # GeoTIFF has no bool type, so masks are written as uint8 
+        profile['dtype'] = np.dtype('uint8')
+        profile['nodata'] = 255
     profile['transform'] = Affine(float(xstep), 0, xf, 0, float(ystep), yf) 
+    return profile
+
+
+def read_h5(fname):
+    with h5py.File(fname, 'r') as f:
+        vel = f['velocity'][()]
+        profile = read_profile(f, 'velocity')
     
     return vel, profile
 
-def write_gtiff(fname, outname=None):
-    '''Read an HDF5 velocity file and write the velocity out to a GeoTiff'''
+def write_gtiff(fname, outname=None, dataset='velocity', block_size=512):
+    '''
+    Stream a MintPy HDF5 dataset (e.g. velocity, timeseries, 
+    temporalCoherence) into a tiled, compressed Cloud-Optimized GeoTIFF with 
+    overviews. 3-D datasets become one band per epoch. The dataset is read 
+    block_size rows at a time, so it is never fully loaded into memory.
+    '''
     if outname is None:
         outname = os.path.splitext(fname)[0] + '.tif'
-    vel, profile = read_h5(fname) 
-    ds = open(outname, "w", **profile)
-    ds.write(vel, 1)
-    ds.close()
+    tmpname = os.path.splitext(outname)[0] + '_tmp.tif'
+
+    with h5py.File(fname, 'r') as f:
+        ds = f[dataset]
+        profile = read_profile(f, dataset)
+        profile.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'BIGTIFF': 'IF_SAFER'})
+        bands = list(range(1, profile['count'] + 1))
+
+        with open(tmpname, "w", **profile) as dst:
+            if ds.ndim == 3 and 'date' in f:
+                for band, date in zip(bands, f['date'][()]):
+                    dst.set_band_description(band, date.decode())
+            for row in range(0, profile['height'], block_size):
+                nrows = min(block_size, profile['height'] - row)
+                window = Window(0, row, profile['width'], nrows)
+                block = ds[..., row:row + nrows, :]
+                if ds.ndim == 2:
+                    block = block[np.newaxis]
+                dst.write(block.astype(profile['dtype'], copy=False), bands, window=window)
+
+    # the COG driver lays out the tiles and builds the overviews
+    rio_copy(tmpname, outname, driver='COG', compress=profile['compress'], overview_resampling='average', BIGTIFF='IF_SAFER')
+    os.remove(tmpname)
 
     
-def reproject_geotiff(input_filename, output_filename, src_epsg, dst_epsg, resampling=Resampling.nearest):
+def reproject_geotiff(input_filename, output_filename, src_epsg, dst_epsg, resampling=Resampling.nearest, resolution=None, cache_dir='.warp_cache'):
   """
   Reprojects a GeoTIFF from one coordinate system to another.
 
+  The source-to-destination pixel mapping is computed once per source grid, 
+  destination CRS, resolution and resampling (see get_warp_index) and then 
+  applied to every band as a vectorized gather. Overviews are built on the 
+  output.
+
   Args:
       input_filename: Path to the input GeoTIFF file.
       output_filename: Path to the output GeoTIFF file.
       src_epsg: EPSG code of the source coordinate system.
       dst_epsg: EPSG code of the destination coordinate system.
-      resampling: Resampling method to use during reprojection (default: nearest).
+      resampling: Resampling method, nearest or bilinear (default: nearest).
+      resolution: Output resolution in destination units (default: computed).
+      cache_dir: Directory in which warp indices are cached.
   """
 
   # Define source and destination CRS objects using pyproj
@@ -85,31 +141,114 @@ def reproject_geotiff(input_filename, output_filename, src_epsg, dst_epsg, resam
 
   # Open the source GeoTIFF
   with open(input_filename) as src:
-    # Get source data, transform, and CRS
-    data = src.read(1)
-    src_transform = src.transform
-    transform, width, height = calculate_default_transform(
-        src.crs, dst_crs_obj, src.width, src.height, *src.bounds)
+    warp = get_warp_index(src.crs, src.transform, src.shape, dst_crs_obj, resolution=resolution, resampling=resampling, cache_dir=cache_dir)
 
     dst_profile = src.meta.copy()
     dst_profile.update({
         'crs': dst_crs_obj, 
-        'transform': transform, 
-        'width': width, 
-        'height': height
+        'transform': Affine(*warp['transform']), 
+        'width': int(warp['width']), 
+        'height': int(warp['height'])
     })
 
-    # Perform reprojection using rasterio.warp.reproject
     with open(output_filename, "w", **dst_profile) as dst:
         for i in range(1,src.count + 1):
-            reproject(
-                source = rasterio.band(src,i),
-                destination = rasterio.band(dst,i),
-                src_transform=src_transform,
-                src_crs=src.crs,
-                dst_crs=dst_crs_obj,
-                resampling=resampling,
-            )
+            dst.write(apply_warp_index(src.read(i), warp, src.nodata), i)
+        # overviews let write_kmz read the upper pyramid levels cheaply
+        nlevels = int(np.ceil(np.log2(max(dst.shape) / 256))) if max(dst.shape) > 256 else 0
+        if nlevels > 0:
+            dst.build_overviews([2 ** k for k in range(1, nlevels + 1)], resampling)
+
+
+def get_warp_index(src_crs, src_transform, src_shape, dst_crs, resolution=None, resampling=Resampling.nearest, cache_dir='.warp_cache'):
+  """
+  Compute, or load from cache_dir, the source pixel index (and bilinear 
+  weights) of every destination pixel for a reprojection.
+
+  Args:
+      src_crs, src_transform, src_shape: Source grid.
+      dst_crs: Destination coordinate system.
+      resolution: Output resolution in destination units (default: computed).
+      resampling: Resampling.nearest or Resampling.bilinear.
+      cache_dir: Directory in which warp indices are cached.
+
+  Returns:
+      dict with the destination transform, width and height and the flat 
+      source 'index' of each destination pixel (-1 outside); bilinear 
+      indices have four neighbours each and a matching 'weight'.
+  """
+  if resampling not in (Resampling.nearest, Resampling.bilinear):
+    raise ValueError('get_warp_index: only nearest and bilinear resampling are supported')
+  src_crs, dst_crs = CRS.from_user_input(src_crs), CRS.from_user_input(dst_crs)
+  key = repr((src_crs.to_wkt(), tuple(src_transform)[:6], tuple(src_shape), dst_crs.to_wkt(), resolution, resampling.name))
+  cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+  if os.path.exists(cache_file):
+    with np.load(cache_file) as f:
+      return dict(f)
+
+  hgt, width = src_shape
+  bounds = array_bounds(hgt, width, src_transform)
+  transform, dst_width, dst_height = calculate_default_transform(
+      src_crs, dst_crs, width, hgt, *bounds, resolution=resolution)
+
+  # source (fractional) pixel coordinates of every destination pixel center
+  rows, cols = np.mgrid[0:dst_height, 0:dst_width]
+  xs, ys = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+  xs, ys = warp_transform(dst_crs, src_crs, xs, ys)
+  scol, srow = ~src_transform * (np.asarray(xs), np.asarray(ys))
+
+  if resampling == Resampling.nearest:
+    r, c = np.floor(srow).astype(np.int64), np.floor(scol).astype(np.int64)
+    index = r * width + c
+    weight = None
+    valid = (r >= 0) & (r < hgt) & (c >= 0) & (c < width)
+  else:
+    r, c = srow - 0.5, scol - 0.5
+    r0, c0 = np.floor(r).astype(np.int64), np.floor(c).astype(np.int64)
+    fr, fc = r - r0, c - c0
+    valid = (r0 >= 0) & (r0 < hgt - 1) & (c0 >= 0) & (c0 < width - 1)
+    index = np.stack([r0 * width + c0, r0 * width + c0 + 1, (r0 + 1) * width + c0, (r0 + 1) * width + c0 + 1], axis=-1)
+    weight = np.stack([(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc], axis=-1)
+  index[~valid] = -1
+
+  warp = {'transform': np.array(tuple(transform)[:6]), 'width': dst_width, 'height': dst_height, 'index': index}
+  if weight is not None:
+    weight[~valid] = 0
+    warp['weight'] = weight
+  # write to a temporary file first so that concurrent jobs never load a partial cache
+  os.makedirs(cache_dir, exist_ok=True)
+  fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+  with os.fdopen(fd, 'wb') as f:
+    np.savez_compressed(f, **warp)
+  os.replace(tmpname, cache_file)
+  return warp
+
+
+def apply_warp_index(data, warp, nodata=None):
+  """
+  Reproject one band with a warp index from get_warp_index. Destination 
+  pixels outside the source, or touching source nodata, are set to nodata.
+  """
+  fill = 0 if nodata is None else nodata
+  flat = data.ravel()
+  index = warp['index']
+  if 'weight' not in warp:
+    # nearest: a plain gather
+    out = flat[np.where(index >= 0, index, 0)]
+    invalid = index < 0
+    if nodata is not None:
+      invalid |= (out == nodata) | np.isnan(out)
+    out[invalid] = fill
+    return out.reshape((int(warp['height']), int(warp['width'])))
+
+  weight = warp['weight']
+  valid = np.all(index >= 0, axis=-1)
+  vals = flat[np.where(index >= 0, index, 0)]
+  if nodata is not None:
+    valid &= ~np.any((vals == nodata) | np.isnan(vals), axis=-1)
+  out = np.sum(vals * weight, axis=-1)
+  out[~valid] = fill
+  return out.reshape((int(warp['height']), int(warp['width']))).astype(data.dtype)
 
 
 def single_band_to_rgb(input_filename, output_filename):
@@ -134,8 +273,234 @@ def single_band_to_rgb(input_filename, output_filename):
     dst.write(rgb_data)
 
 
-if __name__=='__main__':
-    write_gtiff('velocity.h5', outname='velocity.tif')   
-    reproject_geotiff('velocity.tif', 'velocity_geo.tif', '32615', '4326')
-    single_band_to_rgb('velocity_geo.tif', 'velocity_visual.tif')
+KML_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+'''
+KML_FOOTER = '''</Document>
+</kml>
+'''
+
+
+def make_lut(cmap='RdBu_r'):
+    '''Return a (256, 4) uint8 RGBA lookup table for a matplotlib colormap'''
+    return (plt.get_cmap(cmap)(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+
+
+def colorize(data, lut, vmin, vmax, nodata=None):
+    '''
+    Colour-map an array with a lookup table in one vectorized pass; nodata 
+    and NaN pixels are transparent
+    '''
+    scaled = np.nan_to_num((data - vmin) / (vmax - vmin) * 255)
+    rgba = lut[np.clip(scaled, 0, 255).astype(np.uint8)]
+    invalid = np.isnan(data) if nodata is None else np.isnan(data) | (data == nodata)
+    rgba[invalid, 3] = 0
+    return rgba
+
+
+def tile_windows(shape, tile_size=256):
+    '''
+    Return the number of pyramid levels and a dict of {(z, x, y): (window, 
+    decimation)} covering a raster of the given shape. Level maxz is full 
+    resolution and each level above halves it.
+    '''
+    hgt, width = shape
+    maxz = max(0, int(np.ceil(np.log2(max(hgt, width) / tile_size))))
+    tiles = {}
+    for z in range(maxz + 1):
+        f = 2 ** (maxz - z)
+        span = tile_size * f
+        for x in range(int(np.ceil(width / span))):
+            for y in range(int(np.ceil(hgt / span))):
+                window = Window(x * span, y * span, min(span, width - x * span), min(span, hgt - y * span))
+                tiles[(z, x, y)] = (window, f)
+    return maxz, tiles
+
+
+def render_tile(input_filename, window, f, lut, vmin, vmax):
+    '''Read a decimated window of a raster and return it as PNG bytes'''
+    out_shape = (max(1, int(np.ceil(window.height / f))), max(1, int(np.ceil(window.width / f))))
+    with open(input_filename) as src:
+        data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest).astype(float)
+        nodata = src.nodata
+    buf = io.BytesIO()
+    plt.imsave(buf, colorize(data, lut, vmin, vmax, nodata), format='png')
+    return buf.getvalue()
+
+
+def tile_kml(key, tiles, transform, maxz):
+    '''Return the KML of one super-overlay tile with links to its children'''
+    def region(k):
+        window = tiles[k][0]
+        west, north = transform * (window.col_off, window.row_off)
+        east, south = transform * (window.col_off + window.width, window.row_off + window.height)
+        box = f'<north>{north}</north><south>{south}</south><east>{east}</east><west>{west}</west>'
+        max_lod = -1 if k[0] == maxz else 512
+        min_lod = 0 if k[0] == 0 else 128
+        return box, (f'<Region><LatLonAltBox>{box}</LatLonAltBox>'
+                     f'<Lod><minLodPixels>{min_lod}</minLodPixels><maxLodPixels>{max_lod}</maxLodPixels></Lod></Region>\n')
+
+    z, x, y = key
+    box, reg = region(key)
+    kml = KML_HEADER + reg
+    kml += (f'<GroundOverlay><drawOrder>{z}</drawOrder><Icon><href>{y}.png</href></Icon>'
+            f'<LatLonBox>{box}</LatLonBox></GroundOverlay>\n')
+    for child in [(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]:
+        if child in tiles:
+            kml += (f'<NetworkLink>{region(child)[1]}<Link><href>../../{child[0]}/{child[1]}/{child[2]}.kml</href>'
+                    f'<viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n')
+    return kml + KML_FOOTER
+
+
+def bounded_map(executor, fn, items, max_pending):
+    '''
+    Submit fn(*value) for each (key, value) item with at most max_pending in 
+    flight and yield (key, result) as they complete. Each future is dropped 
+    once its result is taken, so finished results are not kept alive.
+    '''
+    items = iter(items)
+    pending = {executor.submit(fn, *value): key for key, value in itertools.islice(items, max_pending)}
+    while pending:
+        done = wait(pending, return_when=FIRST_COMPLETED)[0]
+        while done:
+            future = done.pop()
+            key = pending.pop(future)
+            for next_key, value in itertools.islice(items, 1):
+                pending[executor.submit(fn, *value)] = next_key
+            result = future.result()
+            del future
+            yield key, result
+
 
+def write_kmz(input_filename, output_filename, vmin=None, vmax=None, cmap='RdBu_r', tile_size=256, workers=None):
+    '''
+    Write a geographic (EPSG:4326) single-band GeoTIFF as a KMZ super-overlay: 
+    a level-of-detail pyramid of colour-mapped PNG tiles that Google Earth 
+    loads as the view zooms in. Tiles are rendered in parallel by a process 
+    pool, or inline if workers is 0; vmin/vmax default to a symmetric 98th 
+    percentile range. The upper levels are read from the input's overviews 
+    when it has them (write_gtiff and reproject_geotiff outputs do); the 
+    input is never modified.
+    '''
+    with open(input_filename) as src:
+        if src.crs.to_epsg() != 4326:
+            raise ValueError('write_kmz: {} must be in EPSG:4326, see reproject_geotiff'.format(input_filename))
+        transform, shape = src.transform, src.shape
+
+    maxz, tiles = tile_windows(shape, tile_size)
+    if vmin is None or vmax is None:
+        with open(input_filename) as src:
+            scale = max(1, max(shape) // 1024)
+            preview = src.read(1, out_shape=(shape[0] // scale, shape[1] // scale), masked=True).astype(float).filled(np.nan)
+        vlim = np.nanpercentile(np.abs(preview), 98)
+        vmin, vmax = -vlim, vlim
+
+    lut = make_lut(cmap)
+
+    def rendered():
+        if workers == 0:
+            for key, (window, f) in tiles.items():
+                yield key, render_tile(input_filename, window, f, lut, vmin, vmax)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            render = partial(render_tile, input_filename, lut=lut, vmin=vmin, vmax=vmax)
+            yield from bounded_map(executor, render, tiles.items(), 2 * (workers or os.cpu_count()))
+
+    with ZipFile(output_filename, 'w') as kmz:
+        # Google Earth opens the first .kml in the archive, so the root goes first
+        kmz.writestr('doc.kml', KML_HEADER + '<NetworkLink><Link><href>0/0/0.kml</href></Link></NetworkLink>\n' + KML_FOOTER)
+        for (z, x, y), png in rendered():
+            kmz.writestr(f'{z}/{x}/{y}.png', png)
+            kmz.writestr(f'{z}/{x}/{y}.kml', tile_kml((z, x, y), tiles, transform, maxz))
+
+
+def is_current(output_filename, input_filename):
+    '''True if output_filename exists and is newer than input_filename'''
+    return os.path.exists(output_filename) and os.path.getmtime(output_filename) >= os.path.getmtime(input_filename)
+
+
+def plan_exports(data_dir='.', out_dir=None, dst_epsg='4326', datasets=None, kmz=True):
+    '''
+    Read the attributes of every MintPy HDF5 file in data_dir once and return 
+    a list of export jobs, one per (file, dataset). By default every 
+    top-level dataset on the file's grid is exported.
+    '''
+    out_dir = data_dir if out_dir is None else out_dir
+    jobs = []
+    for fname in sorted(glob.glob(os.path.join(data_dir, '*.h5'))):
+        stem = os.path.splitext(os.path.basename(fname))[0]
+        with h5py.File(fname, 'r') as f:
+            if 'WIDTH' not in f.attrs:
+                continue
+            width = int(f.attrs['WIDTH'])
+            src_epsg = str(f.attrs.get('EPSG', '4326'))
+            names = datasets if datasets is not None else [k for k in f if isinstance(f[k], h5py.Dataset)]
+            for name in names:
+                if name not in f or f[name].ndim < 2 or f[name].shape[-1] != width:
+                    continue
+                base = os.path.join(out_dir, stem if name == stem else '{}_{}'.format(stem, name))
+                tif = base + '.tif'
+                geo = tif if src_epsg == str(dst_epsg) else base + '_geo.tif'
+                jobs.append({
+                    'fname': fname, 
+                    'dataset': name, 
+                    'src_epsg': src_epsg, 
+                    'dst_epsg': str(dst_epsg),
+                    'tif': tif, 
+                    'geo': geo, 
+                    'kmz': base + '.kmz' if kmz and f[name].ndim == 2 and str(dst_epsg) == '4326' else None,
+                })
+    return jobs
+
+
+def run_export(job):
+    '''Run one export job, skipping each step whose output is up to date'''
+    done = []
+    if not is_current(job['tif'], job['fname']):
+        write_gtiff(job['fname'], job['tif'], dataset=job['dataset'])
+        done.append(job['tif'])
+    if job['geo'] != job['tif'] and not is_current(job['geo'], job['tif']):
+        reproject_geotiff(job['tif'], job['geo'], job['src_epsg'], job['dst_epsg'])
+        done.append(job['geo'])
+    if job['kmz'] is not None and not is_current(job['kmz'], job['geo']):
+        write_kmz(job['geo'], job['kmz'], workers=0)
+        done.append(job['kmz'])
+    return done
+
+
+def batch_export(data_dir='.', out_dir=None, dst_epsg='4326', datasets=None, kmz=True, workers=None):
+    '''Export every MintPy HDF5 file in data_dir concurrently with a process pool'''
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    jobs = plan_exports(data_dir, out_dir, dst_epsg, datasets, kmz)
+    print('{} datasets to export from {}'.format(len(jobs), data_dir))
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_export, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                done = future.result()
+            except Exception as e:
+                failed.append(job)
+                print('Failed to export {}:{} ({})'.format(job['fname'], job['dataset'], e))
+                continue
+            print('{}:{} -> {}'.format(job['fname'], job['dataset'], ', '.join(done) if done else 'up to date'))
+    return failed
+
+
+def cmdLineParse():
+    parser = argparse.ArgumentParser(description='Export MintPy HDF5 outputs to GeoTIFF, reprojected GeoTIFF and KMZ')
+    parser.add_argument('-d', '--data-dir', dest='dataDir', type=str, default='.', help='directory of MintPy HDF5 files (default: %(default)s)')
+    parser.add_argument('-o', '--out-dir', dest='outDir', type=str, default=None, help='output directory (default: the data directory)')
+    parser.add_argument('-e', '--epsg', type=str, default='4326', help='EPSG code to reproject to (default: %(default)s)')
+    parser.add_argument('--datasets', type=str, nargs='+', default=None, help='datasets to export (default: all datasets on the file grid)')
+    parser.add_argument('--no-kmz', dest='kmz', action='store_false', help='do not write KMZ super-overlays')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of files exported in parallel')
+    return parser.parse_args()
+
+
+if __name__=='__main__':
+    inps = cmdLineParse()
+    batch_export(inps.dataDir, inps.outDir, inps.epsg, inps.datasets, inps.kmz, inps.workers)
@@ -1,80 +1,294 @@
-import datetime
+import argparse
 import glob
 import h5py
+import itertools
 import os
 import rasterio
 import re
+import xml.etree.ElementTree as ET
+
+from collections import OrderedDict
+from functools import partial
 
 import numpy as np
+import scipy.sparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from osgeo import gdal
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu
 
 
-def main(ifgList,refCenter=None,refSize=None):
+def main(ifgList,refCenter=None,refSize=None,refMask=None,blockSize=None,filename='ts.h5',workers=None,corrList=None,nlooks=1,incremental=False,sparse=False,reader='gdal'):
     '''
     Read in a list of interferograms and create a time-series and velocity map. 
+    The interferograms are referenced to a refCenter/refSize box or point, or 
+    to the pixels of a boolean refMask. If blockSize is given, the stack is read, inverted and written blockSize 
+    rows at a time so that the full stack is never held in memory. If workers 
+    is given, the row blocks are inverted in parallel by a process pool. If 
+    corrList (coherence files in the same order as ifgList) is given, the 
+    inversion is weighted by the coherence-derived phase variance. If 
+    incremental is True, only interferograms not already in filename are 
+    read (see updateTS). If sparse is True, G is built as a sparse matrix 
+    and factored once for all blocks. reader selects the readIFG backend.
     '''
+    if incremental:
+        updateTS(ifgList, filename=filename, blockSize=blockSize or 256, refCenter=refCenter, refSize=refSize, refMask=refMask, corrList=corrList, nlooks=nlooks, reader=reader)
+        return
+
     datePairs, dates = getDates(ifgList)
-    fracDates = np.array([dt2fracYear(d) for d in dates])
-    G = makeG(dates, datePairs)
-    data = getData(ifgList,1)
-    data = dereference(data, taxis=0,refCenter=refCenter,refSize=refSize)
-    tsArray = makeTS(G, data, fracDates)
+    fracDates = dt2fracYear(dates)
+    G = makeG(dates, datePairs, sparse=sparse)
+    reportComponents(dates, findComponents(dates, datePairs))
+    pinvCache = PatternCache()
+    if workers is not None and blockSize is None:
+        blockSize = 256
+
+    if reader == 'gdal':
+        checkGrid(scanRasters(ifgList)[0])
+
+    if blockSize is None:
+        data = getData(ifgList,1,reader=reader)
+        data = dereference(data, taxis=0,refCenter=refCenter,refSize=refSize,refMask=refMask)
+        if corrList is None:
+            tsArray = makeTS(G, data, fracDates, pinvCache=pinvCache)
+        else:
+            weights = 1 / corr2var(getData(corrList,1,reader=reader), nlooks=nlooks)
+            tsArray = makeWeightedTS(G, data, weights, fracDates=fracDates)
+        vel = findMeanVel(tsArray, fracDates, 0)
+        vel = convertRad2meters(vel)
+        writeTS2HDF5(tsArray, fracDates,vel,filename=filename)
+        return
+
+    xSize, ySize = getRasterSize(ifgList[0], reader=reader)
+    refRegion = getRefRegion((ySize, xSize), refCenter=refCenter, refSize=refSize, refMask=refMask)
+    refVals = getRefValues(ifgList, refRegion, band_num=1, reader=reader, refMask=refMask, blockSize=blockSize)
+    initTSHDF5(fracDates, (ySize, xSize), blockSize, filename=filename)
+    windows = [(0, row, xSize, min(blockSize, ySize - row)) for row in range(0, ySize, blockSize)]
+
+    if workers is None:
+        for window in windows:
+            tsArray, vel = invertBlock(ifgList, G, fracDates, refVals, window, pinvCache=pinvCache, corrList=corrList, nlooks=nlooks, reader=reader)
+            writeTS2HDF5(tsArray, fracDates, vel, filename=filename, rowStart=window[1])
+            print('Finished rows {} to {} of {}'.format(window[1], window[1] + window[3], ySize))
+        return
+
+    # workers only read and invert; all HDF5 writes happen here in the parent process
+    invert = partial(invertBlock, ifgList, G, fracDates, refVals, corrList=corrList, nlooks=nlooks, reader=reader)
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker) as executor:
+        for window, (tsArray, vel) in boundedMap(executor, invert, windows, 2 * workers):
+            writeTS2HDF5(tsArray, fracDates, vel, filename=filename, rowStart=window[1])
+            print('Finished rows {} to {} of {}'.format(window[1], window[1] + window[3], ySize))
+
+
+def boundedMap(executor, fn, items, maxPending):
+    '''
+    Submit fn(item) for each item with at most maxPending in flight and yield 
+    (item, result) as they complete. Each future is dropped once its result 
+    is taken, so finished blocks are not kept alive.
+    '''
+    items = iter(items)
+    pending = {executor.submit(fn, item): item for item in itertools.islice(items, maxPending)}
+    while pending:
+        done = wait(pending, return_when=FIRST_COMPLETED)[0]
+        while done:
+            future = done.pop()
+            item = pending.pop(future)
+            for nextItem in itertools.islice(items, 1):
+                pending[executor.submit(fn, nextItem)] = nextItem
+            result = future.result()
+            del future
+            yield item, result
+
+
+class PatternCache(OrderedDict):
+    '''
+    A pinvCache holding at most maxsize per-pattern solvers. The least 
+    recently used are dropped, so memory stays bounded on scenes with many 
+    distinct NaN patterns (each entry is about Nt x Nifg floats).
+    '''
+    def __init__(self, maxsize=512):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# per-process pseudo-inverse cache, set up by initWorker in each pool worker
+WORKER_CACHE = None
+
+
+def initWorker():
+    '''Give a pool worker its own pinvCache, reused for every block it inverts'''
+    global WORKER_CACHE
+    WORKER_CACHE = PatternCache()
+
+
+def invertBlock(ifgList, G, fracDates, refVals, window, pinvCache=None, corrList=None, nlooks=1, reader='gdal'):
+    '''
+    Read a (xstart, ystart, xStep, yStep) window of every interferogram, 
+    subtract the reference values and return the time-series and velocity. 
+    In a pool worker pinvCache defaults to the worker's cache (see initWorker).
+    '''
+    if pinvCache is None:
+        pinvCache = WORKER_CACHE
+    xstart, ystart, xStep, yStep = window
+    data = getData(ifgList, 1, xstart=xstart, ystart=ystart, xStep=xStep, yStep=yStep, reader=reader)
+    data -= refVals[:, np.newaxis, np.newaxis]
+    if corrList is None:
+        tsArray = makeTS(G, data, fracDates, pinvCache=pinvCache)
+    else:
+        corr = getData(corrList, 1, xstart=xstart, ystart=ystart, xStep=xStep, yStep=yStep, reader=reader)
+        tsArray = makeWeightedTS(G, data, 1 / corr2var(corr, nlooks=nlooks), fracDates=fracDates)
     vel = findMeanVel(tsArray, fracDates, 0)
     vel = convertRad2meters(vel)
-    writeTS2HDF5(tsArray, fracDates,vel)
+    return tsArray, vel
+
+
+DATE_PAIR_RE = re.compile(r'(\d{8})(?:T\d*)?_(\d{8})(?:T\d*)?')
 
 
 def getDates(ifgList):
-    datePairs = []
-    unique_dates = []
+    '''
+    Parse the date pairs out of a list of interferogram names. Returns an 
+    (Npairs, 2) datetime64[D] array of pairs and the sorted unique dates.
+    '''
+    dateStrings = np.array([DATE_PAIR_RE.search(ifg).groups() for ifg in ifgList]) # any time signature is dropped
+    datePairs = dateStr2dt64(dateStrings)
+    return datePairs, np.unique(datePairs)
 
-    for ifg in ifgList:
-        ds1, ds2 = re.search("\d{8}T*\d*_\d{8}T*\d*", ifg).group().split('_') # grab the date(time) strings
-        d1, d2 = [datetime.datetime.strptime(re.sub('T\d{6}', '', d), '%Y%m%d') for d in (ds1, ds2)] # remove any time signature
-        if d1 not in unique_dates:
-            unique_dates.append(d1)
-        if d2 not in unique_dates:
-            unique_dates.append(d2)
-        datePairs.append((d1,d2))
 
-    unique_dates.sort()
+def dateStr2dt64(dateStrings):
+    '''
+    Convert an array of YYYYMMDD strings to datetime64[D]
+    '''
+    ymd = np.asarray(dateStrings).astype(np.int64)
+    months = (ymd // 10000 - 1970) * 12 + ymd // 100 % 100 - 1
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (ymd % 100 - 1).astype('timedelta64[D]')
+
+
+def dt642dateStr(dates):
+    '''
+    Convert an array of datetime64 to YYYYMMDD strings
+    '''
+    return np.char.replace(np.datetime_as_string(dates, unit='D'), '-', '')
+
 
-    return datePairs, np.array(unique_dates)
+def dt2fracYear(dates):
+    '''
+    Convert datetime64 date(s) to decimal years
+    '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    year = dates.astype('datetime64[Y]')
+    startOfThisYear = year.astype('datetime64[D]')
+    startOfNextYear = (year + 1).astype('datetime64[D]')
+    fraction = (dates - startOfThisYear) / (startOfNextYear - startOfThisYear)
+    return year.astype(np.int64) + 1970 + fraction
 
 
-def dt2fracYear(date):
-    import datetime as dt
-    import time
+def makeG(dates, pairs, sparse=False):
+    '''
+    Create a time-series G-matrix. "dates" should be sorted ascending and 
+    "pairs" is an (Npairs, 2) array of dates as returned by getDates. If 
+    sparse is True a scipy.sparse CSR matrix is returned.
+    '''
+    index = np.searchsorted(dates, pairs)
+    rows = np.arange(len(pairs))
+    if sparse:
+        data = np.tile([-1., 1.], len(pairs))
+        return scipy.sparse.csr_matrix((data, (np.repeat(rows, 2), index.ravel())), shape=(len(pairs), len(dates)))
+    G = np.zeros((len(pairs), len(dates)))
+    G[rows, index[:, 0]] = -1
+    G[rows, index[:, 1]] = 1
+    return G
 
-    def sinceEpoch(date): # returns seconds since epoch
-        return time.mktime(date.timetuple())
-    s = sinceEpoch
 
-    # check that the object is a datetime
-    year = date.year
+def findComponents(dates, pairs):
+    '''
+    Find the connected components of the interferogram network with a 
+    union-find over the date pairs. Returns a component label for every date; 
+    the component containing the first date is labelled 0.
+    '''
+    parent = np.arange(len(dates))
 
-    startOfThisYear = dt.datetime(year=year, month=1, day=1)
-    startOfNextYear = dt.datetime(year=year+1, month=1, day=1)
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
 
-    yearElapsed = s(date) - s(startOfThisYear)
-    yearDuration = s(startOfNextYear) - s(startOfThisYear)
-    fraction = yearElapsed/yearDuration
-    date_frac = date.year + fraction
+    for i, j in np.searchsorted(dates, pairs):
+        ri, rj = root(i), root(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
 
-    return date_frac
+    roots = np.array([root(i) for i in range(len(dates))])
+    return np.unique(roots, return_inverse=True)[1]
 
 
-def makeG(dates, pairs):
+def reportComponents(dates, labels):
     '''
-    Create a time-series G-matrix. "dates" should be sorted ascending.
+    Print a summary of the network components if the network is disconnected
     '''
-    G = np.zeros((len(pairs), len(dates)))
-    for k, (d1, d2) in enumerate(pairs):
-        index1= dates == d1
-        index2 = dates == d2
-        G[k,index1] = -1
-        G[k,index2] = 1
-    return G
+    ncomp = labels.max() + 1
+    if ncomp == 1:
+        return
+    print('Warning: interferogram network has {} disconnected components'.format(ncomp))
+    for c in range(ncomp):
+        cdates = dates[labels == c]
+        print('  component {}: {} dates from {} to {}'.format(c, len(cdates), cdates[0], cdates[-1]))
+
+
+def alignComponents(array, t, labels, taxis=0):
+    '''
+    Tie the time-series of disconnected network components together. Each 
+    component is only known up to a constant, so a common velocity and one 
+    offset per component are fit and the relative offsets are removed.
+    '''
+    ncomp = labels.max() + 1
+    if ncomp == 1:
+        return array
+    in_shape = array.shape
+    Nt = in_shape[taxis]
+    flat_array = np.swapaxes(array,0,taxis).reshape((Nt, -1))
+
+    G = np.zeros((Nt, ncomp + 1))
+    G[np.arange(Nt), labels] = 1
+    G[:, -1] = t - t[0]
+    that = np.linalg.pinv(G) @ flat_array
+    offsets = that[:ncomp] - that[:1]
+    flat_array = flat_array - offsets[labels]
+    return np.swapaxes(flat_array.reshape((Nt,) + tuple(np.delete(in_shape, taxis))), 0, taxis)
+
+
+def patternComponents(adj):
+    '''
+    Return the observed dates and the component labels of the observed dates 
+    for a boolean (Nt, Nt) date adjacency, e.g. the non-zeros of G^T G for 
+    the valid interferograms of one NaN pattern
+    '''
+    observed = np.diagonal(adj).copy()
+    labels = connected_components(scipy.sparse.csr_matrix(adj[np.ix_(observed, observed)]), directed=False)[1]
+    return observed, labels
+
+
+def alignPattern(sol, t, observed, labels):
+    '''
+    Set the unobserved dates of a (Nt, Npix) pattern solution to NaN and tie 
+    the components of the pattern's network together, in place
+    '''
+    sol[~observed] = np.nan
+    if t is not None and len(labels) > 0 and labels.max() > 0:
+        sol[observed] = alignComponents(sol[observed], t[observed], labels)
+    return sol
 
 
 def readRaster(filename, band_num = None):
@@ -111,57 +325,481 @@ def readRaster(filename, band_num = None):
     return xSize, ySize, dType, geoProj, trans, noDataVal, Nbands
 
 
-def getData(ifgList, band_num):
-    pix=[]
-    for ifg in ifgList:
-        pix.append(readIFG(ifg,band_num=band_num))
-    pix = np.array(pix)
+def scanRasters(fileList, workers=16):
+    '''
+    Read the metadata of many rasters concurrently (GDAL releases the GIL 
+    while opening files). Returns a structured array with one row per file 
+    and the list of unique projections indexed by its projId field.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda f: readRaster(f, band_num=1), fileList))
+
+    projections = sorted(set(r[3] for r in results))
+    meta = np.zeros(len(fileList), dtype=[
+        ('file', 'U{}'.format(max(len(f) for f in fileList))), ('xSize', 'i4'), ('ySize', 'i4'),
+        ('dType', 'i4'), ('projId', 'i4'), ('trans', 'f8', (6,)), ('noData', 'f8'), ('nBands', 'i4'),
+    ])
+    meta['file'] = fileList
+    meta['xSize'], meta['ySize'], meta['dType'] = zip(*[r[:3] for r in results])
+    meta['projId'] = [projections.index(r[3]) for r in results]
+    meta['trans'] = [r[4] for r in results]
+    meta['noData'] = [np.nan if r[5] is None else r[5] for r in results]
+    meta['nBands'] = [r[6] for r in results]
+    return meta, projections
+
+
+def checkGrid(meta):
+    '''
+    Raise a RuntimeError if the rasters scanned by scanRasters do not all 
+    share the grid of the first one
+    '''
+    bad = (meta['xSize'] != meta['xSize'][0]) | (meta['ySize'] != meta['ySize'][0]) \
+        | (meta['projId'] != meta['projId'][0]) | np.any(meta['trans'] != meta['trans'][0], axis=1)
+    if bad.any():
+        raise RuntimeError('checkGrid: {} files do not share the grid of {}: {}'.format(
+            bad.sum(), meta['file'][0], ', '.join(meta['file'][bad][:10])))
+
+
+def getData(ifgList, band_num, xstart=0, ystart=0, xStep=None, yStep=None, reader='gdal'):
+    '''
+    Read a (window of a) list of interferograms into a single pre-allocated 
+    array of shape (len(ifgList), rows, cols)
+    '''
+    first = readIFG(ifgList[0], band_num=band_num, xstart=xstart, ystart=ystart, xStep=xStep, yStep=yStep, reader=reader)
+    pix = np.empty((len(ifgList),) + first.shape, dtype=first.dtype)
+    pix[0] = first
+    for k, ifg in enumerate(ifgList[1:], start=1):
+        pix[k] = readIFG(ifg, band_num=band_num, xstart=xstart, ystart=ystart, xStep=xStep, yStep=yStep, reader=reader)
     return pix 
 
 
-def dereference(array, taxis=0,refCenter = None, refSize = None):
-    #taxis must be 0
-    if taxis!=0:
-        raise RuntimeError('taxis must be zero')
-    
+def getRefRegion(shape, refCenter=None, refSize=None, refMask=None):
+    '''
+    Return the (row1, row2, col1, col2) bounds of the reference region for 
+    an image of the given (rows, cols) shape. The region is a refSize square 
+    (refSize=1 for a single point) around refCenter, or the bounding box of 
+    refMask if a reference mask is given.
+    '''
+    if refMask is not None:
+        rows, cols = np.nonzero(refMask)
+        if len(rows) == 0:
+            raise RuntimeError('Reference mask contains no pixels')
+        print('Reference region is a mask of {} pixels'.format(len(rows)))
+        return rows.min(), rows.max()+1, cols.min(), cols.max()+1
+
     if refCenter is None:
-        nshape = array.shape[1:]
-        refCenter = [d//2 for d in nshape]
+        refCenter = [d//2 for d in shape]
         print('Reference region is centered on {}/{}'.format(refCenter[0],refCenter[1]))
     if refSize is None:
         refSize = 10
         print('Reference region is {} square pixels'.format(refSize**2))
 
-    row1,row2,col1,col2=refCenter[0]-refSize//2,refCenter[0]+refSize//2,refCenter[1]-refSize//2,refCenter[1]+refSize//2
-    for k in range(array.shape[taxis]):
-        array[k,...] - np.nanmean(array[k,list(range(row1,row2)),list(range(col1,col2))])
+    row1, col1 = max(refCenter[0]-refSize//2, 0), max(refCenter[1]-refSize//2, 0)
+    return row1, min(row1+refSize, shape[0]), col1, min(col1+refSize, shape[1])
+
+
+def getRefValues(ifgList, refRegion, band_num=1, reader='gdal', refMask=None, blockSize=256):
+    '''
+    Read only the reference region of each interferogram and return the 
+    per-interferogram reference value. The region is read blockSize rows at 
+    a time, so a scattered refMask does not load the whole stack.
+    '''
+    row1,row2,col1,col2 = refRegion
+    sums = np.zeros(len(ifgList))
+    counts = np.zeros(len(ifgList))
+    for row in range(row1, row2, blockSize):
+        nrows = min(blockSize, row2 - row)
+        refData = getData(ifgList, band_num, xstart=col1, ystart=row, xStep=col2-col1, yStep=nrows, reader=reader).astype(float)
+        valid = ~np.isnan(refData)
+        if refMask is not None:
+            valid &= refMask[row:row+nrows, col1:col2]
+        sums += np.where(valid, refData, 0).sum(axis=(1,2))
+        counts += valid.sum(axis=(1,2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def refMean(refData, refMask=None):
+    '''
+    Return the NaN-mean of each (rows, cols) slice of refData, optionally 
+    only over the pixels where refMask is True
+    '''
+    if refMask is not None:
+        refData = np.where(refMask, refData, np.nan)
+    return np.nanmean(refData, axis=(1,2))
+
+
+def dereference(array, taxis=0,refCenter = None, refSize = None, refMask = None):
+    '''
+    Subtract the mean of a reference point, box or mask from every 
+    interferogram, in place
+    '''
+    #taxis must be 0
+    if taxis!=0:
+        raise RuntimeError('taxis must be zero')
+    
+    row1,row2,col1,col2 = getRefRegion(array.shape[1:], refCenter=refCenter, refSize=refSize, refMask=refMask)
+    if refMask is not None:
+        refMask = refMask[row1:row2, col1:col2]
+    array -= refMean(array[:, row1:row2, col1:col2], refMask)[:, np.newaxis, np.newaxis]
     return array
 
 
-def makeTS(G, array, fracDates, taxis = 0):
+def makeTS(G, array, fracDates, taxis = 0, pinvCache=None):
+    '''
+    Invert a stack of interferograms for a time-series. Pixels are grouped by 
+    their pattern of valid (non-NaN) interferograms and each group is solved 
+    with one pseudo-inverse of the reduced G (or, for a scipy.sparse G, one 
+    sparse LU factorization of its normal equations). Dates with no valid 
+    interferogram in a pattern are NaN, and if the pattern's network is 
+    disconnected its components are tied together with alignComponents 
+    (given fracDates). Pass a dict as pinvCache to reuse the factorizations 
+    across blocks.
+    '''
+    if pinvCache is None:
+        pinvCache = {}
     in_shape = array.shape
     Nt = G.shape[-1]
     nshape = tuple(s for i,s in enumerate(in_shape) if i!=taxis)
     narray = np.swapaxes(array,0,taxis)
-    flat_array = array.reshape((in_shape[taxis],)+(np.prod(nshape),))
-    that,res,rank,s = np.linalg.lstsq(G,flat_array, rcond=None) 
+    flat_array = narray.reshape((in_shape[taxis],)+(np.prod(nshape),))
+
+    valid = ~np.isnan(flat_array)
+    masks = np.packbits(valid, axis=0).T
+    patterns, inverse = np.unique(masks, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+
+    that = np.full((Nt, flat_array.shape[1]), np.nan)
+    for pattern, idx in zip(patterns, groups):
+        key = pattern.tobytes()
+        mask = valid[:, idx[0]]
+        if not mask.any():
+            continue
+        if key not in pinvCache:
+            Gm = G[mask]
+            # dates without a valid pair in this pattern are unconstrained, 
+            # and NaN gaps can split the pattern's network into components
+            adj = abs(Gm).T @ abs(Gm)
+            adj = (adj.toarray() if scipy.sparse.issparse(adj) else adj) != 0
+            pinvCache[key] = (getSolver(Gm),) + patternComponents(adj)
+        solve, observed, labels = pinvCache[key]
+        that[:, idx] = alignPattern(solve(flat_array[np.ix_(mask, idx)]), fracDates, observed, labels)
+
     out_array = that.reshape((Nt,)+nshape)
     return out_array
     
 
+def getSolver(G):
+    '''
+    Return a function that solves G x = d for a (Nifg, Npix) array d. A dense 
+    G uses its pseudo-inverse; a sparse G is factored once via its normal 
+    equations with the first date held fixed, falling back to the dense 
+    pseudo-inverse if the network is disconnected.
+    '''
+    if scipy.sparse.issparse(G):
+        # the normal equations are only non-singular for a connected network
+        if connected_components(abs(G).T @ abs(G), directed=False)[0] > 1:
+            return getSolver(G.toarray())
+        Gr = G[:, 1:].tocsc()
+        lu = splu((Gr.T @ Gr).tocsc())
+
+        def solve(d):
+            m = lu.solve(np.asarray(Gr.T @ d))
+            sol = np.concatenate([np.zeros((1, m.shape[1])), m], axis=0)
+            return sol - sol.mean(axis=0)
+        return solve
+
+    Ginv = np.linalg.pinv(G)
+    return lambda d: Ginv @ d
+
+
+def corr2var(corr, nlooks=1):
+    '''
+    Convert coherence to interferometric phase variance (Cramer-Rao bound)
+    '''
+    corr = np.clip(corr, 1e-3, 0.999)
+    return (1 - corr**2) / (2 * nlooks * corr**2)
+
+
+def makeWeightedTS(G, array, weights, chunkSize=None, fracDates=None):
+    '''
+    Weighted least-squares time-series inversion, solved per pixel with 
+    batched normal equations. array and weights are (Nifg, rows, cols); NaN 
+    data or weights are given zero weight. Like makeTS, the solution is the 
+    minimum-norm one, dates without valid data are NaN and disconnected 
+    components are aligned if fracDates is given.
+    '''
+    if scipy.sparse.issparse(G):
+        G = G.toarray()
+    Nifg, Nt = G.shape
+    nshape = array.shape[1:]
+    d = array.reshape((Nifg, -1))
+    w = weights.reshape((Nifg, -1))
+    if chunkSize is None:
+        chunkSize = max(1, int(1e7 // Nt**2))
+
+    that = np.empty((Nt, d.shape[1]))
+    for p0 in range(0, d.shape[1], chunkSize):
+        N, rhs = getNormalEqs(G, d[:, p0:p0+chunkSize], w[:, p0:p0+chunkSize])
+        that[:, p0:p0+chunkSize] = solveNormalEqs(N, rhs, fracDates)
+
+    return that.reshape((Nt,)+nshape)
+
+
+def getNormalEqs(G, d, w=None):
+    '''
+    Return the per-pixel normal equations G^T W G (Npix, Nt, Nt) and G^T W d 
+    (Npix, Nt) for flattened (Nifg, Npix) data and weights. NaN data or 
+    weights contribute nothing.
+    '''
+    if w is None:
+        w = np.ones(d.shape)
+    bad = np.isnan(d) | np.isnan(w)
+    d = np.where(bad, 0, d)
+    w = np.where(bad, 0, w)
+    N = np.einsum('kp,ki,kj->pij', w, G, G, optimize=True)
+    rhs = np.einsum('kp,ki,kp->pi', w, G, d, optimize=True)
+    return N, rhs
+
+
+def solveNormalEqs(N, rhs, t=None):
+    '''
+    Solve per-pixel normal equations and return the (Nt, Npix) minimum-norm 
+    time-series, as makeTS does; dates without data are NaN. Pixels are 
+    grouped by the sparsity pattern of N, and if t is given the components 
+    of each pattern's network are aligned.
+    '''
+    sol = np.empty((N.shape[1], len(N)))
+    adj = N != 0
+    # rows of packed bits viewed as single void scalars sort far faster than np.unique(axis=0)
+    packed = np.ascontiguousarray(np.packbits(adj.reshape((len(N), -1)), axis=1))
+    inverse = np.unique(packed.view(np.dtype((np.void, packed.shape[1]))).ravel(), return_inverse=True)[1].ravel()
+    order = np.argsort(inverse, kind='stable')
+    for idx in np.split(order, np.cumsum(np.bincount(inverse))[:-1]):
+        observed, labels = patternComponents(adj[idx[0]])
+        if observed.all() and labels.max() == 0:
+            # connected network: N is only singular along the constant vector, so 
+            # hold the first date fixed, solve, and take the zero-mean solution
+            m = np.linalg.solve(N[idx, 1:, 1:], rhs[idx, 1:, np.newaxis])[..., 0]
+            m = np.concatenate([np.zeros((len(idx), 1)), m], axis=1)
+            sol[:, idx] = (m - m.mean(axis=1, keepdims=True)).T
+            continue
+        # pinv(G^T W G) G^T W d is the minimum-norm weighted least-squares solution
+        m = np.einsum('pij,pj->ip', np.linalg.pinv(N[idx], hermitian=True), rhs[idx])
+        sol[:, idx] = alignPattern(m, t, observed, labels)
+    return sol
+
+
+def updateTS(ifgList, filename='ts.h5', blockSize=256, refCenter=None, refSize=None, refMask=None, corrList=None, nlooks=1, reader='gdal'):
+    '''
+    Incrementally update a time-series file, so that on a rerun only the 
+    interferograms not yet folded in are read. Without weights G^T G only 
+    depends on a pixel's NaN pattern, so the output stores G^T d per pixel 
+    plus a table of patterns and a per-pixel pattern id, and each pattern is 
+    solved once through a pinvCache as in makeTS. With corrList the 
+    per-pixel weighted normal equations G^T W G are stored instead.
+    '''
+    oldIfgs, oldDates = [], []
+    if os.path.exists(filename):
+        with h5py.File(filename,'r') as f:
+            if 'GtWd' in f:
+                oldIfgs = [n.decode() for n in f['ifgs'][()]]
+                oldDates = [n.decode() for n in f['dateStrings'][()]]
+                refRegion = tuple(f.attrs['refRegion'])
+                refMask = f['refMask'][()] if 'refMask' in f else None
+                if ('GtWG' in f) != (corrList is not None):
+                    raise RuntimeError('updateTS: {} was built {} coherence weights; rerun without incremental'.format(
+                        filename, 'with' if 'GtWG' in f else 'without'))
+
+    newIdx = [k for k, ifg in enumerate(ifgList) if os.path.basename(ifg) not in oldIfgs]
+    if len(newIdx) == 0:
+        print('No new interferograms to add to {}'.format(filename))
+        return
+    newIfgs = [ifgList[k] for k in newIdx]
+    newCorr = None if corrList is None else [corrList[k] for k in newIdx]
+    allIfgs = oldIfgs + [os.path.basename(ifg) for ifg in newIfgs]
+    print('Adding {} new interferograms to {}'.format(len(newIfgs), filename))
+
+    newPairs, newDates = getDates(newIfgs)
+    dates = np.union1d(newDates, dateStr2dt64(oldDates))
+    dateStrings = dt642dateStr(dates)
+    fracDates = dt2fracYear(dates)
+    G = makeG(dates, newPairs)
+    allPairs = getDates(allIfgs)[0]
+    reportComponents(dates, findComponents(dates, allPairs))
+    Nt = len(dates)
+    oldIdx = np.searchsorted(dateStrings, oldDates)
+
+    xSize, ySize = getRasterSize(newIfgs[0], reader=reader)
+    if len(oldIfgs) == 0:
+        refRegion = getRefRegion((ySize, xSize), refCenter=refCenter, refSize=refSize, refMask=refMask)
+    refVals = getRefValues(newIfgs, refRegion, band_num=1, reader=reader, refMask=refMask, blockSize=blockSize)
+
+    tmpname = filename + '.tmp'
+    old = h5py.File(filename,'r') if len(oldIfgs) > 0 else None
+    with h5py.File(tmpname,'w') as out:
+        chunkRows, chunkCols = min(blockSize, ySize), min(256, xSize)
+        out.create_dataset('ts', shape=(Nt, ySize, xSize), dtype='float32', chunks=(Nt, chunkRows, chunkCols))
+        out.create_dataset('vel', shape=(ySize, xSize), dtype='float32', chunks=(chunkRows, chunkCols))
+        out['dates'] = fracDates
+        out['dateStrings'] = np.array(dateStrings, dtype='S8')
+        out['ifgs'] = np.array(allIfgs, dtype='S')
+        out.attrs['refRegion'] = refRegion
+        if refMask is not None:
+            out['refMask'] = np.asarray(refMask, dtype=bool)
+
+        if newCorr is None:
+            updatePatternTS(out, old, newIfgs, refVals, G, makeG(dates, allPairs), oldIdx, fracDates, blockSize, reader)
+        else:
+            updateWeightedTS(out, old, newIfgs, newCorr, nlooks, refVals, G, oldIdx, fracDates, blockSize, reader)
+
+    if old is not None:
+        old.close()
+    os.replace(tmpname, filename)
+
+
+def updatePatternTS(out, old, newIfgs, refVals, G, Gall, oldIdx, fracDates, blockSize, reader='gdal'):
+    '''
+    Unweighted part of updateTS: fold the new interferograms into the 
+    per-pixel G^T d and NaN pattern of the old file (if any), solve each 
+    pattern's normal equations once and write ts/vel, GtWd, pattern and 
+    patterns to out
+    '''
+    Nt, ySize, xSize = out['ts'].shape
+    nOld, nNew = Gall.shape[0] - len(newIfgs), len(newIfgs)
+    chunkRows, chunkCols = out['ts'].chunks[1:]
+    out.create_dataset('GtWd', shape=(Nt, ySize, xSize), dtype='float64', chunks=(Nt, chunkRows, chunkCols))
+    out.create_dataset('pattern', shape=(ySize, xSize), dtype='int32', chunks=(chunkRows, chunkCols))
+    oldPatterns = old['patterns'][()] if old is not None else None
+    patternIds = {}
+    pinvCache = PatternCache()
+
+    for row in range(0, ySize, blockSize):
+        nrows = min(blockSize, ySize - row)
+        data = getData(newIfgs, 1, xstart=0, ystart=row, xStep=xSize, yStep=nrows, reader=reader)
+        data -= refVals[:, np.newaxis, np.newaxis]
+        d = data.reshape((nNew, -1))
+        valid = ~np.isnan(d)
+        rhs = G.T @ np.where(valid, d, 0)
+
+        # key each pixel by its old pattern id and new valid bits; only the 
+        # unique keys are expanded into full patterns over all interferograms
+        keys = np.packbits(valid, axis=0).T
+        if old is not None:
+            rhs[oldIdx] += old['GtWd'][:, row:row+nrows, :].reshape((len(oldIdx), -1))
+            oldId = old['pattern'][row:row+nrows, :].ravel()
+            keys = np.concatenate([oldId.view(np.uint8).reshape((-1, 4)), keys], axis=1)
+        keys = np.ascontiguousarray(keys)
+        uniq, first, inverse = np.unique(keys.view(np.dtype((np.void, keys.shape[1]))).ravel(), return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+
+        ts = np.empty((Nt, rhs.shape[1]))
+        ids = np.empty(rhs.shape[1], dtype='int32')
+        order = np.argsort(inverse, kind='stable')
+        for p0, idx in zip(first, np.split(order, np.cumsum(np.bincount(inverse))[:-1])):
+            mask = valid[:, p0]
+            if old is not None:
+                mask = np.concatenate([np.unpackbits(oldPatterns[oldId[p0]], count=nOld).astype(bool), mask])
+            key = np.packbits(mask).tobytes()
+            ids[idx] = patternIds.setdefault(key, len(patternIds))
+            if key not in pinvCache:
+                Gm = Gall[mask]
+                pinvCache[key] = (getSolver(Gm.T @ Gm),) + patternComponents((abs(Gm).T @ abs(Gm)) != 0)
+            solve, observed, labels = pinvCache[key]
+            ts[:, idx] = alignPattern(solve(rhs[:, idx]), fracDates, observed, labels)
+
+        ts = ts.reshape((Nt, nrows, xSize))
+        out['ts'][:, row:row+nrows, :] = ts
+        out['vel'][row:row+nrows, :] = convertRad2meters(findMeanVel(ts, fracDates, 0))
+        out['GtWd'][:, row:row+nrows, :] = rhs.reshape((Nt, nrows, xSize))
+        out['pattern'][row:row+nrows, :] = ids.reshape((nrows, xSize))
+        print('Finished rows {} to {} of {}'.format(row, row + nrows, ySize))
+
+    patterns = np.zeros((len(patternIds), (nOld + nNew + 7) // 8), dtype=np.uint8)
+    for key, k in patternIds.items():
+        patterns[k] = np.frombuffer(key, dtype=np.uint8)
+    out['patterns'] = patterns
+
+
+def updateWeightedTS(out, old, newIfgs, newCorr, nlooks, refVals, G, oldIdx, fracDates, blockSize, reader='gdal'):
+    '''
+    Weighted part of updateTS: add the new interferograms to the per-pixel 
+    G^T W G and G^T W d of the old file (if any), solve and write ts/vel, 
+    GtWG and GtWd to out. The (Nt, Nt) accumulators are loaded, updated and 
+    solved in tiles of about chunkSize pixels, as in makeWeightedTS.
+    '''
+    Nt, ySize, xSize = out['ts'].shape
+    nOldDates = len(oldIdx)
+    iu = np.triu_indices(Nt)
+    oiu = np.triu_indices(nOldDates)
+    chunkSize = max(1, int(1e7 // Nt**2))
+    tileRows = max(1, chunkSize // xSize)
+    tileCols = min(xSize, chunkSize)
+    out.create_dataset('GtWG', shape=(len(iu[0]), ySize, xSize), dtype='float64', chunks=(len(iu[0]), min(tileRows, ySize), tileCols))
+    out.create_dataset('GtWd', shape=(Nt, ySize, xSize), dtype='float64', chunks=(Nt, min(tileRows, ySize), tileCols))
+
+    for row in range(0, ySize, blockSize):
+        nrows = min(blockSize, ySize - row)
+        data = getData(newIfgs, 1, xstart=0, ystart=row, xStep=xSize, yStep=nrows, reader=reader)
+        data -= refVals[:, np.newaxis, np.newaxis]
+        corr = getData(newCorr, 1, xstart=0, ystart=row, xStep=xSize, yStep=nrows, reader=reader)
+        weights = 1 / corr2var(corr, nlooks=nlooks)
+
+        tsArray = np.empty((Nt, nrows, xSize))
+        for r0 in range(0, nrows, tileRows):
+            for c0 in range(0, xSize, tileCols):
+                rs, cs = slice(r0, min(r0 + tileRows, nrows)), slice(c0, min(c0 + tileCols, xSize))
+                frs = slice(row + rs.start, row + rs.stop)
+                tshape = (rs.stop - rs.start, cs.stop - cs.start)
+                npix = tshape[0] * tshape[1]
+                N = np.zeros((npix, Nt, Nt))
+                rhs = np.zeros((npix, Nt))
+                if old is not None:
+                    packed = old['GtWG'][:, frs, cs].reshape((len(oiu[0]), -1)).T
+                    N[:, oldIdx[oiu[0]], oldIdx[oiu[1]]] = packed
+                    N[:, oldIdx[oiu[1]], oldIdx[oiu[0]]] = packed
+                    rhs[:, oldIdx] = old['GtWd'][:, frs, cs].reshape((nOldDates, -1)).T
+
+                w = weights[:, rs, cs].reshape((len(newIfgs), -1))
+                dN, drhs = getNormalEqs(G, data[:, rs, cs].reshape((len(newIfgs), -1)), w)
+                N += dN
+                rhs += drhs
+
+                tsArray[:, rs, cs] = solveNormalEqs(N, rhs, fracDates).reshape((Nt,) + tshape)
+                out['GtWG'][:, frs, cs] = N[:, iu[0], iu[1]].T.reshape((len(iu[0]),) + tshape)
+                out['GtWd'][:, frs, cs] = rhs.T.reshape((Nt,) + tshape)
+
+        vel = convertRad2meters(findMeanVel(tsArray, fracDates, 0))
+        out['ts'][:, row:row+nrows, :] = tsArray
+        out['vel'][row:row+nrows, :] = vel
+        print('Finished rows {} to {} of {}'.format(row, row + nrows, ySize))
+
+
 def findMeanVel(array, t, taxis=0):
+    '''
+    Fit a line through the time-series of each pixel and return the slope. 
+    Only the non-NaN epochs of a pixel are used; pixels with fewer than two 
+    are NaN.
+    '''
     in_shape = array.shape
     Nt = in_shape[taxis]
     nshape = tuple(s for i,s in enumerate(in_shape) if i!=taxis)
     narray = np.swapaxes(array,0,taxis)
-    flat_array = array.reshape((Nt,)+(np.prod(nshape),))
+    flat_array = narray.reshape((Nt,)+(np.prod(nshape),))
 
-    G = np.ones((in_shape[taxis],)+(2,))
-    G[:,1] = t - t[0]
-
-    that,res,rank,s = np.linalg.lstsq(G,flat_array, rcond=None) 
-    out_vel = that.reshape((2,)+nshape)
-    return out_vel[1,...]
+    # closed-form least-squares slope from per-pixel sums over the valid epochs
+    valid = ~np.isnan(flat_array)
+    tt = np.where(valid, (t - t[0])[:, np.newaxis], 0)
+    dd = np.where(valid, flat_array, 0)
+    n = valid.sum(axis=0)
+    st, sd = tt.sum(axis=0), dd.sum(axis=0)
+    denom = n * (tt * tt).sum(axis=0) - st**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vel = (n * (tt * dd).sum(axis=0) - st * sd) / denom
+    vel[(n < 2) | (denom == 0)] = np.nan
+    return vel.reshape(nshape)
     
 
 def convertRad2meters(vel, lam=0.056):
@@ -171,15 +809,54 @@ def convertRad2meters(vel, lam=0.056):
     return vel/(4*np.pi/lam)
 
 
-def writeTS2HDF5(array, dates, vel,filename='ts.h5'):
+def initTSHDF5(dates, shape, blockSize, filename='ts.h5'):
+    '''
+    Pre-allocate chunked ts/vel datasets of the full output size so that 
+    blocks can be written into them as they are inverted
+    '''
+    ySize, xSize = shape
+    # column tiles keep chunks small and a pixel's time-series cheap to read
+    chunkRows, chunkCols = min(blockSize, ySize), min(256, xSize)
     with h5py.File(filename,'w') as f:
-        f['ts'] = array
+        f.create_dataset('ts', shape=(len(dates), ySize, xSize), dtype='float32',
+                         chunks=(len(dates), chunkRows, chunkCols))
+        f.create_dataset('vel', shape=(ySize, xSize), dtype='float32',
+                         chunks=(chunkRows, chunkCols))
         f['dates'] = dates
-        f['vel']=vel
-    print('Finished writing {} to disk'.format(filename))
 
 
-def readIFG(ifg, band_num=1, xstart=0, ystart=0, xStep=None,yStep=None):
+def writeTS2HDF5(array, dates, vel,filename='ts.h5', rowStart=None):
+    '''
+    Write a time-series and velocity to disk. If rowStart is given, the 
+    arrays are a block of rows written into datasets created by initTSHDF5
+    '''
+    if rowStart is None:
+        with h5py.File(filename,'w') as f:
+            f['ts'] = array
+            f['dates'] = dates
+            f['vel']=vel
+        print('Finished writing {} to disk'.format(filename))
+        return
+
+    rowEnd = rowStart + vel.shape[0]
+    with h5py.File(filename,'r+') as f:
+        f['ts'][:, rowStart:rowEnd, :] = array
+        f['vel'][rowStart:rowEnd, :] = vel
+
+
+def readIFG(ifg, band_num=1, xstart=0, ystart=0, xStep=None,yStep=None, reader='gdal'):
+    '''
+    Read a band (or window of a band) of an interferogram. With 
+    reader='mmap' raw binary files described by a VRT or ENVI header are 
+    returned as a read-only view of a numpy.memmap, so only the pages of the 
+    window are read from disk.
+    '''
+    if reader == 'mmap':
+        data = openMemmap(ifg, band_num=band_num)
+        if xStep is None:
+            return data
+        return data[ystart:ystart+yStep, xstart:xstart+xStep]
+
     ds = gdal.Open(ifg)
     if xStep is None:
         data = ds.GetRasterBand(band_num).ReadAsArray()
@@ -189,9 +866,95 @@ def readIFG(ifg, band_num=1, xstart=0, ystart=0, xStep=None,yStep=None):
     return data
 
 
+GDAL_DTYPES = {'Byte': 'u1', 'UInt16': 'u2', 'Int16': 'i2', 'UInt32': 'u4', 'Int32': 'i4',
+               'Float32': 'f4', 'Float64': 'f8', 'CFloat32': 'c8', 'CFloat64': 'c16'}
+ENVI_DTYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 6: 'c8', 9: 'c16', 12: 'u2', 13: 'u4'}
+
+
+def getRasterSize(filename, reader='gdal'):
+    '''
+    Return the (xSize, ySize) of a raster
+    '''
+    if reader == 'mmap':
+        ySize, xSize = openMemmap(filename).shape
+        return xSize, ySize
+    return readRaster(filename, band_num=1)[:2]
+
+
+def openMemmap(filename, band_num=1):
+    '''
+    Return a band of a raw binary raster as a 2-D numpy.memmap view. The 
+    layout is read from a VRT (VRTRawRasterBand) or ENVI .hdr header.
+    '''
+    if not filename.endswith('.vrt') and os.path.exists(filename + '.vrt'):
+        filename = filename + '.vrt'
+    if filename.endswith('.vrt'):
+        layout = readRawVRTLayout(filename, band_num)
+    else:
+        layout = readENVILayout(filename, band_num)
+    binfile, dtype, shape, offset, strides = layout
+    buf = np.memmap(binfile, dtype=np.uint8, mode='r')
+    return np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset, strides=strides)
+
+
+def readRawVRTLayout(vrt_file, band_num=1):
+    '''
+    Read the binary layout of a band from a raw VRT file. Returns the binary 
+    file name, dtype, (rows, cols) shape, byte offset and byte strides.
+    '''
+    root = ET.parse(vrt_file).getroot()
+    band = [b for b in root.findall('VRTRasterBand') if int(b.get('band', 1)) == band_num]
+    if len(band) == 0 or band[0].find('ImageOffset') is None:
+        raise ValueError('No raw VRTRasterBand {} found in file: {}'.format(band_num, vrt_file))
+    band = band[0]
+
+    src = band.find('SourceFilename')
+    binfile = src.text
+    if src.get('relativeToVRT', '0') == '1':
+        binfile = os.path.join(os.path.dirname(vrt_file), binfile)
+    byteorder = '>' if band.findtext('ByteOrder', 'LSB') == 'MSB' else '<'
+    dtype = np.dtype(byteorder + GDAL_DTYPES[band.get('dataType')])
+    shape = (int(root.get('rasterYSize')), int(root.get('rasterXSize')))
+    strides = (int(band.findtext('LineOffset')), int(band.findtext('PixelOffset')))
+    return binfile, dtype, shape, int(band.findtext('ImageOffset')), strides
+
+
+def readENVILayout(filename, band_num=1):
+    '''
+    Read the binary layout of a band from an ENVI .hdr file, returned in the 
+    same form as readRawVRTLayout
+    '''
+    hdr = filename + '.hdr'
+    if not os.path.exists(hdr):
+        hdr = os.path.splitext(filename)[0] + '.hdr'
+    with open(hdr) as f:
+        meta = dict(line.split('=', 1) for line in f if '=' in line)
+    meta = {k.strip().lower(): v.strip() for k, v in meta.items()}
+
+    nx, ny = int(meta['samples']), int(meta['lines'])
+    nbands = int(meta.get('bands', 1))
+    byteorder = '>' if meta.get('byte order', '0') == '1' else '<'
+    dtype = np.dtype(byteorder + ENVI_DTYPES[int(meta['data type'])])
+    size = dtype.itemsize
+    offset = int(meta.get('header offset', 0))
+    interleave = meta.get('interleave', 'bsq').lower()
+    if interleave == 'bsq':
+        offset += (band_num - 1) * nx * ny * size
+        strides = (nx * size, size)
+    elif interleave == 'bil':
+        offset += (band_num - 1) * nx * size
+        strides = (nbands * nx * size, size)
+    else:
+        offset += (band_num - 1) * size
+        strides = (nbands * nx * size, nbands * size)
+    return filename, dtype, (ny, nx), offset, strides
+
+
 def gdal_open(fname, returnProj=False, userNDV=None, band=None):
     '''
-    Reads a rasterio-compatible raster file and returns the data and profile
+    Reads a rasterio-compatible raster file and returns the data and profile. 
+    All bands are read at once as float32 with nodata set to NaN; a 
+    multi-band file is returned as one (bands, rows, cols) array.
     '''
     if rasterio is None:
         raise ImportError('RAiDER.utilFcns: rio_open - rasterio is not installed')
@@ -202,30 +965,13 @@ def gdal_open(fname, returnProj=False, userNDV=None, band=None):
     with rasterio.open(fname) as src:
         profile = src.profile
 
-        # For all bands
-        nodata = src.nodatavals
+        # the masked read flags each band's nodata value
+        masked = src.read(band, out_dtype='float32', masked=True)
 
-        # If user requests a band
-        if band is not None:
-            ndv = nodata[band - 1]
-            data = src.read(band).squeeze()
-            nodataToNan(data, [userNDV, nodata[band - 1]])
-
-        else:
-            data = src.read().squeeze()
-            if data.ndim > 2:
-                for bnd in range(data.shape[0]):
-                    val = data[bnd, ...]
-                    nodataToNan(val, [userNDV, nodata[bnd]])
-            else:
-                nodataToNan(data, list(nodata) + [userNDV])
-
-
-        if data.ndim > 2:
-            dlist = []
-            for k in range(data.shape[0]):
-                dlist.append(data[k,...].copy())
-            data = dlist
+    data = masked.data
+    np.putmask(data, np.ma.getmaskarray(masked), np.nan)
+    nodataToNan(data, [userNDV])
+    data = data.squeeze()
 
     if not returnProj:
         return data
@@ -236,12 +982,13 @@ def gdal_open(fname, returnProj=False, userNDV=None, band=None):
 
 def nodataToNan(inarr, listofvals):
     """
-    Setting values to nan as needed
+    Setting values to nan as needed, in place. inarr must be a float array 
+    since nans cannot be integers (i.e. in DEM)
     """
-    inarr = inarr.astype(float) # nans cannot be integers (i.e. in DEM)
     for val in listofvals:
         if val is not None:
-            inarr[inarr == val] = np.nan
+            np.putmask(inarr, inarr == val, np.nan)
+    return inarr
         
 
 def getTSfromIFGs(i,j,ifg, band_num=1):
@@ -251,7 +998,32 @@ def getTSfromIFGs(i,j,ifg, band_num=1):
     return value[0][0]
 
 
+def cmdLineParse():
+    parser = argparse.ArgumentParser(description='Create a time-series and velocity map from a stack of unwrapped interferograms')
+    parser.add_argument('-i', '--ifgs', type=str, default='*_unw.vrt', help='glob pattern of unwrapped interferograms (default: %(default)s)')
+    parser.add_argument('-o', '--outfile', type=str, default='ts.h5', help='output HDF5 file (default: %(default)s)')
+    parser.add_argument('-b', '--block-size', dest='blockSize', type=int, default=None, help='number of rows to invert at a time; the full stack is loaded if not given')
+    parser.add_argument('-c', '--corr', type=str, default=None, help='glob pattern of coherence files used to weight the inversion')
+    parser.add_argument('-n', '--nlooks', type=int, default=1, help='number of looks used to convert coherence to phase variance (default: %(default)s)')
+    parser.add_argument('--ref-yx', dest='refYX', type=int, nargs=2, default=None, metavar=('Y', 'X'), help='center of the reference region, e.g. from findRP.py (default: image center)')
+    parser.add_argument('--ref-size', dest='refSize', type=int, default=None, help='size of the square reference region in pixels; 1 for a single point (default: 10)')
+    parser.add_argument('--ref-mask', dest='refMask', type=str, default=None, help='raster whose non-zero pixels form the reference region')
+    parser.add_argument('-r', '--reader', type=str, default='gdal', choices=['gdal', 'mmap'], help='raster reader; mmap memory-maps raw VRT/ENVI binaries (default: %(default)s)')
+    parser.add_argument('--sparse', action='store_true', help='use a sparse design matrix and factorization for large networks')
+    parser.add_argument('--incremental', action='store_true', help='only add interferograms not already in the output file')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of processes used to invert row blocks in parallel')
+    return parser.parse_args()
+
+
 if __name__=='__main__':
-    import glob
-    ifgList = glob.glob('*_unw.vrt')
-    main(ifgList)
+    inps = cmdLineParse()
+    ifgList = glob.glob(inps.ifgs)
+    corrList = None
+    if inps.corr is not None:
+        from process_data import find_matching_file
+        corrFiles = glob.glob(inps.corr)
+        corrList = [find_matching_file(corrFiles, ifg) for ifg in ifgList]
+    refMask = None
+    if inps.refMask is not None:
+        refMask = readIFG(inps.refMask) != 0
+    main(ifgList, refCenter=inps.refYX, refSize=inps.refSize, refMask=refMask, blockSize=inps.blockSize, filename=inps.outfile, workers=inps.workers, corrList=corrList, nlooks=inps.nlooks, incremental=inps.incremental, sparse=inps.sparse, reader=inps.reader)
@@ -1,37 +1,48 @@
 import glob
+import h5py
+import hashlib
+import itertools
+import json
 import math
 import os
 import rasterio
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from tqdm import tqdm
 
 import geopandas as gpd
+import matplotlib.pyplot as plt
 import numpy as np
 import rioxarray as rio
+import xarray as xr
 
 from pathlib import Path
-from rasterio.mask import mask, raster_geometry_mask
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio import windows
+from rasterio.features import geometry_mask
+from rasterio.warp import transform, transform_bounds
 
 
 
-def run_resampling(path_to_shapefile, data_dir='DATA'):
-    '''Resamples a set of raster to ahve the same bounds'''
-    glob_path = Path(os.getcwd())
-    amp_files =[str(pp) for pp in glob_path.glob('**/*amp.tif')]
-    unw_files =[str(pp) for pp in glob_path.glob('**/*unw_phase.tif')]
-    ph_files = [str(pp) for pp in glob_path.glob('**/*wrapped_phase.tif')]
-    cor_files = [str(pp) for pp in glob_path.glob('**/*corr.tif')]
-    dem_files = [str(pp) for pp in glob_path.glob('**/*dem.tif')]
-    lv_theta_files = [str(pp) for pp in glob_path.glob('**/*lv_theta.tif')]
-    lv_phi_files = [str(pp) for pp in glob_path.glob('**/*lv_phi.tif')]
-    inc_files = [str(pp) for pp in glob_path.glob('**/*inc_map.tif')]
-    inc_ell_files = [str(pp) for pp in glob_path.glob('**/*inc_map_ell.tif')]
-    mask_files = [str(pp) for pp in glob_path.glob('**/*water_mask.tif')]
-    vert_disp_files = [str(pp) for pp in glob_path.glob('**/*vert_disp.tif')]
-    los_disp_files = [str(pp) for pp in glob_path.glob('**/*los_disp.tif')]
+HYP3_LAYERS = [
+    'amp', 'unw_phase', 'wrapped_phase', 'corr', 'dem', 'lv_theta', 'lv_phi',
+    'inc_map', 'inc_map_ell', 'water_mask', 'vert_disp', 'los_disp',
+]
 
-    ref_file = 100
+
+def run_resampling(path_to_shapefile, data_dir='DATA', workers=None, stack_file=None, incremental=False):
+    '''
+    Resamples a set of raster to ahve the same bounds. If workers is given, 
+    pairs are processed in parallel by a process pool. If stack_file is 
+    given, the clipped layers are written into one chunked HDF5 cube (see 
+    create_stack) instead of an _int.tif beside every input. If incremental 
+    is True, pairs whose _int.tif outputs are up to date according to the 
+    manifest are skipped (_int.tif output only). Returns a list of (file, 
+    error message) for the files that failed.
+    '''
+    index = build_product_index(data_dir)
+    unw_files = [layers['unw_phase'] for key, layers in sorted(index.items()) if 'unw_phase' in layers]
+
+    ref_file = min(100, len(unw_files) - 1)
 
     # Get basic info from the reference file
     with rasterio.open(unw_files[ref_file]) as r_int:
@@ -52,36 +63,232 @@ def run_resampling(path_to_shapefile, data_dir='DATA'):
     dst_height = int((bounds[3] - bounds[1]) / -yres)
     out_dict = {'transform': dst_transform, 'width': dst_width, 'height': dst_height, 'crs': crs, 'bounds': bounds, 'proj': shp}
 
-    for k, uf in tqdm(enumerate(unw_files), total=len(unw_files)):
-        af = find_matching_file(amp_files, uf)
-        ph = find_matching_file(ph_files, uf)
-        cf = find_matching_file(cor_files, uf)
-        df = find_matching_file(dem_files, uf)
-        lvf = find_matching_file(lv_theta_files, uf)
-        lpf= find_matching_file(lv_phi_files, uf)
-        incf = find_matching_file(inc_files, uf)
-        ief = find_matching_file(inc_ell_files, uf)
-        mf = find_matching_file(mask_files, uf)
-        vf = find_matching_file(vert_disp_files, uf)
-        lf = find_matching_file(los_disp_files, uf)
-
-        # loop through all interferograms and coherence rasters, clip to area of interest
-        transform_with_shapefile(af,   out_dict)
-        transform_with_shapefile(uf,   out_dict)
-        transform_with_shapefile(ph,   out_dict)
-        transform_with_shapefile(cf,   out_dict)
-        transform_with_shapefile(df,   out_dict)
-        transform_with_shapefile(lvf,  out_dict)
-        transform_with_shapefile(lpf,  out_dict)
-        transform_with_shapefile(incf, out_dict)
-        transform_with_shapefile(ief,  out_dict)
-        transform_with_shapefile(mf,   out_dict)
-        transform_with_shapefile(vf,   out_dict)
-        transform_with_shapefile(lf,   out_dict)
-
-        if k % 10 == 0:
-            print(f'Currently running file #{k} of {len(unw_files)}.')
+    keys = [key for key, layers in sorted(index.items()) if 'unw_phase' in layers]
+    if stack_file is not None:
+        create_stack(stack_file, keys, out_dict)
+    elif incremental:
+        manifest_file = os.path.join(data_dir, 'resampling_manifest.json')
+        manifest = read_manifest(manifest_file)
+        params = params_signature(out_dict)
+        keys = [key for key in keys if not pair_is_current(index[key], manifest, params)]
+        print(f'{len(keys)} pairs need processing')
+
+    failures = []
+    stack = h5py.File(stack_file, 'r+') if stack_file is not None else None
+    # clipped pairs are buffered until a whole chunk of pairs can be written at once
+    buffered = {}
+    next_group = 0
+    group_size = stack[HYP3_LAYERS[0]].chunks[0] if stack is not None else 1
+    pairs = [index[key] for key in keys]
+    try:
+        if workers is None:
+            results = ((k, process_pair(layers, out_dict, stack=stack is not None)) for k, layers in enumerate(pairs))
+        else:
+            # each worker opens its own rasterio datasets; the stack is only written here
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = bounded_map(executor, process_pair, pairs, 2 * workers, param_dict=out_dict, stack=stack is not None)
+        for k, (failed, arrays) in tqdm(results, total=len(pairs)):
+            failures += failed
+            if stack is None:
+                continue
+            buffered[k] = arrays
+            while next_group * group_size < len(pairs):
+                k0 = next_group * group_size
+                ks = range(k0, min(k0 + group_size, len(pairs)))
+                if not all(j in buffered for j in ks):
+                    break
+                write_to_stack(stack, k0, [buffered.pop(j) for j in ks])
+                next_group += 1
+    finally:
+        if workers is not None:
+            executor.shutdown()
+        if stack is not None:
+            stack.close()
+
+    if stack_file is None and incremental:
+        failed = set(fname for fname, msg in failures)
+        for key in keys:
+            for path in index[key].values():
+                if path not in failed:
+                    manifest[int_name(path)] = file_signature(path, params)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f)
+
+    if len(failures) > 0:
+        print(f'{len(failures)} files could not be processed:')
+        for fname, msg in failures:
+            print(f'  {fname}: {msg}')
+    return failures
+
+
+def bounded_map(executor, fn, items, max_pending, **kwargs):
+    '''
+    Submit fn(item, **kwargs) for each item with at most max_pending in 
+    flight and yield (index, result) as they complete. Each future is dropped 
+    once its result is taken, so finished results are not kept alive.
+    '''
+    items = enumerate(items)
+    pending = {executor.submit(fn, item, **kwargs): k for k, item in itertools.islice(items, max_pending)}
+    while pending:
+        done = wait(pending, return_when=FIRST_COMPLETED)[0]
+        while done:
+            future = done.pop()
+            k = pending.pop(future)
+            for j, item in itertools.islice(items, 1):
+                pending[executor.submit(fn, item, **kwargs)] = j
+            result = future.result()
+            del future
+            yield k, result
+
+
+def int_name(raster):
+    '''Name of the clipped output written for raster'''
+    return os.path.splitext(raster)[0] + '_int.tif'
+
+
+def params_signature(param_dict):
+    '''
+    Return a hash of the AOI geometry and destination grid used for clipping
+    '''
+    sig = (
+        param_dict['crs'].to_wkt(),
+        tuple(param_dict['transform'])[:6],
+        param_dict['width'],
+        param_dict['height'],
+        [geom.wkb_hex for geom in param_dict['proj']['geometry']],
+    )
+    return hashlib.sha1(repr(sig).encode()).hexdigest()
+
+
+def file_signature(raster, params):
+    '''
+    Return the manifest entry for an input raster processed with params
+    '''
+    st = os.stat(raster)
+    return {'input': raster, 'size': st.st_size, 'mtime': st.st_mtime, 'params': params}
+
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def pair_is_current(layers, manifest, params):
+    '''
+    True if every layer of a pair has an output whose manifest entry matches 
+    the current input file and clipping parameters
+    '''
+    for path in layers.values():
+        out = int_name(path)
+        if not os.path.exists(out) or manifest.get(out) != file_signature(path, params):
+            return False
+    return True
+
 
+def parse_hyp3_name(fname):
+    '''
+    Split a HyP3 product file name into (date1, date2, product-id, layer). 
+    Returns None if the file is not a HyP3 layer.
+    '''
+    # format: S1AA_20200920T001203_20201002T001203_VVP012_INT80_G_ueF_1234_unw_phase.tif
+    stem, ext = os.path.splitext(os.path.basename(fname))
+    parts = stem.split('_')
+    if ext != '.tif' or len(parts) < 9:
+        return None
+    layer = '_'.join(parts[8:])
+    if layer not in HYP3_LAYERS:
+        return None
+    return parts[1], parts[2], parts[7], layer
+
+
+def build_product_index(data_dir='.', index_file='hyp3_index.json', refresh=False):
+    '''
+    Walk data_dir once and index every HyP3 layer by its (date1, date2, 
+    product-id) key, returning {key: {layer: path}}. The index is saved to 
+    index_file inside data_dir with the mtime of every folder, and on later 
+    runs only folders whose mtime has changed are listed again, unless 
+    refresh is True.
+    '''
+    index_path = os.path.join(data_dir, index_file)
+    if not os.path.exists(index_path):
+        # create the sidecar first so that writing it does not change the directory mtime
+        open(index_path, 'w').close()
+    saved = {}
+    if not refresh and os.path.getsize(index_path) > 0:
+        with open(index_path) as f:
+            saved = json.load(f).get('folders', {})
+
+    folders = {}
+    index_folder(data_dir, '.', saved, folders)
+    with open(index_path, 'w') as f:
+        json.dump({'folders': folders}, f)
+
+    products = {}
+    for entry in folders.values():
+        for key, layers in entry['products'].items():
+            products.setdefault(key, {}).update(layers)
+    return {key: {layer: os.path.join(data_dir, path) for layer, path in layers.items()}
+            for key, layers in products.items()}
+
+
+def index_folder(data_dir, rel, saved, folders):
+    '''
+    Add the index entry of folder rel (relative to data_dir) and of its 
+    subfolders to folders, reusing the saved entry of any folder whose mtime 
+    is unchanged
+    '''
+    path = os.path.join(data_dir, rel)
+    mtime = os.path.getmtime(path)
+    entry = saved.get(rel)
+    if entry is None or entry['mtime'] != mtime:
+        entry = {'mtime': mtime, 'subdirs': [], 'products': {}}
+        for item in os.scandir(path):
+            item_rel = os.path.normpath(os.path.join(rel, item.name))
+            if item.is_dir():
+                entry['subdirs'].append(item_rel)
+                continue
+            parsed = parse_hyp3_name(item.name)
+            if parsed is not None:
+                entry['products'].setdefault('_'.join(parsed[:3]), {})[parsed[3]] = item_rel
+    folders[rel] = entry
+    for sub in entry['subdirs']:
+        index_folder(data_dir, sub, saved, folders)
+
+
+def open_stack(data_dir='DATA', layers=None, chunks=512, clipped=False):
+    '''
+    Build a lazy xarray.Dataset over the indexed HyP3 products with one 
+    variable per layer along a "pair" dimension. Each raster is opened as 
+    dask chunks of chunks x chunks pixels, so nothing is read until compute, 
+    e.g. open_stack(d)['corr'].median('pair').compute(). The layers must 
+    share a grid; use clipped=True to stack the _int.tif outputs of 
+    run_resampling.
+    '''
+    index = build_product_index(data_dir)
+    keys = [key for key, product in sorted(index.items()) if 'unw_phase' in product]
+    if layers is None:
+        layers = HYP3_LAYERS
+
+    data_vars = {}
+    for layer in layers:
+        layer_keys = [key for key in keys if layer in index[key]]
+        if len(layer_keys) == 0:
+            continue
+        arrays = []
+        for key in layer_keys:
+            path = int_name(index[key][layer]) if clipped else index[key][layer]
+            da = rio.open_rasterio(path, chunks={'x': chunks, 'y': chunks}, masked=True, lock=False)
+            arrays.append(da.squeeze('band', drop=True))
+        data_vars[layer] = xr.concat(arrays, dim='pair', join='outer').assign_coords(pair=layer_keys)
+
+    ds = xr.Dataset(data_vars)
+    ds = ds.assign_coords(
+        date1=('pair', [key.split('_')[0] for key in ds['pair'].values]),
+        date2=('pair', [key.split('_')[1] for key in ds['pair'].values]),
+    )
+    return ds
 
 
 def update_file(orig_file, ref_file):
@@ -106,23 +313,124 @@ def find_matching_file(flist, f):
     return None
 
 
-def plot_extents(data_dir):
-    unw_files = glob.glob(data_dir + os.sep + '*' + os.sep + '*unw_phase.tif')
-    NS_bounds = []
-    for f in unw_files:
-        with rasterio.open(f) as F:
-            NS_bounds.append(F.bounds[:2])
+QA_DTYPE = [
+    ('pair', 'U64'), ('date1', 'datetime64[D]'), ('date2', 'datetime64[D]'),
+    ('temporal_baseline', 'i4'), ('perp_baseline', 'f8'),
+    ('left', 'f8'), ('bottom', 'f8'), ('right', 'f8'), ('top', 'f8'),
+    ('height', 'i4'), ('width', 'i4'), ('crs', 'U64'),
+]
+
+
+def read_header(raster):
+    '''Return the bounds, shape and CRS of a raster without reading data'''
+    with rasterio.open(raster) as src:
+        return tuple(src.bounds), src.shape, src.crs.to_string()
 
-    de = np.array(NS_bounds).mean(axis=0)
 
-    for k, pair in enumerate(NS_bounds):
-        plt.plot([k,k], [pair[0]-de[0], pair[1]-de[1]], '-k')
-    plt.ylim([de[0] - 100, de[1] + 100])
+def read_baseline(raster):
+    '''
+    Return the perpendicular baseline from the HyP3 metadata .txt file next 
+    to a product layer, or NaN if it is not available
+    '''
+    meta_file = raster.rsplit('_unw_phase', 1)[0] + '.txt'
+    if not os.path.exists(meta_file):
+        return np.nan
+    with open(meta_file) as f:
+        for line in f:
+            if line.startswith('Baseline:'):
+                return float(line.split(':')[1])
+    return np.nan
+
+
+def scan_products(data_dir='DATA', workers=16):
+    '''
+    Read only the headers of every unw_phase layer, concurrently with a thread 
+    pool, and return a structured array (see QA_DTYPE) with one row per pair
+    '''
+    index = build_product_index(data_dir)
+    keys = [key for key, layers in sorted(index.items()) if 'unw_phase' in layers]
+    files = [index[key]['unw_phase'] for key in keys]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = list(executor.map(read_header, files))
+        baselines = list(executor.map(read_baseline, files))
+
+    table = np.zeros(len(keys), dtype=QA_DTYPE)
+    table['pair'] = keys
+    dates = np.array([[d[:4] + '-' + d[4:6] + '-' + d[6:8] for d in key.split('_')[:2]] for key in keys], dtype='datetime64[D]').reshape((-1, 2))
+    table['date1'], table['date2'] = dates[:, 0], dates[:, 1]
+    table['temporal_baseline'] = (dates[:, 1] - dates[:, 0]).astype(int)
+    table['perp_baseline'] = baselines
+    bounds = np.array([h[0] for h in headers]).reshape((-1, 4))
+    for k, name in enumerate(['left', 'bottom', 'right', 'top']):
+        table[name] = bounds[:, k]
+    shapes = np.array([h[1] for h in headers]).reshape((-1, 2))
+    table['height'], table['width'] = shapes[:, 0], shapes[:, 1]
+    table['crs'] = [h[2] for h in headers]
+    return table
+
+
+def find_outliers(table, nsigma=3):
+    '''
+    Flag frames whose CRS or shape differs from the most common one, or whose 
+    center lies more than nsigma robust standard deviations from the median. 
+    Returns a dict of {pair: reason}.
+    '''
+    outliers = {}
+    for name in ['crs', 'height', 'width']:
+        values, counts = np.unique(table[name], return_counts=True)
+        odd = table[name] != values[counts.argmax()]
+        for pair, value in zip(table['pair'][odd], table[name][odd]):
+            outliers.setdefault(str(pair), []).append(f'{name} is {value}')
+
+    for name, (lo, hi) in {'x': ('left', 'right'), 'y': ('bottom', 'top')}.items():
+        center = (table[lo] + table[hi]) / 2
+        dev = center - np.median(center)
+        mad = 1.4826 * np.median(np.abs(dev))
+        if mad == 0:
+            continue
+        for pair in table['pair'][np.abs(dev) > nsigma * mad]:
+            outliers.setdefault(str(pair), []).append(f'{name} center is offset')
+
+    return {pair: ', '.join(reasons) for pair, reasons in outliers.items()}
+
+
+def plot_extents(data_dir, table=None, outliers=None):
+    '''
+    Plot the N-S and E-W extent of every pair relative to the mean, with 
+    outlier frames in red, and save it to Network_extents.png
+    '''
+    if table is None:
+        table = scan_products(data_dir)
+    if outliers is None:
+        outliers = find_outliers(table)
+    k = np.arange(len(table))
+    color = np.where(np.isin(table['pair'], list(outliers)), 'r', 'k')
+
+    fig, axs = plt.subplots(2, 1, sharex=True, figsize=(10, 6))
+    for ax, (lo, hi), label in zip(axs, [('bottom', 'top'), ('left', 'right')], ['N-S extent', 'E-W extent']):
+        de = (table[lo].mean(), table[hi].mean())
+        ax.vlines(k, table[lo] - de[0], table[hi] - de[1], colors=color)
+        ax.set_ylabel(label)
+    axs[-1].set_xlabel('Pair #')
 
     plt.savefig('Network_extents.png')
     plt.close('all')
 
 
+def qa_report(data_dir='DATA', workers=16):
+    '''
+    Scan a downloaded HyP3 batch, plot its extents and print the outlier 
+    frames. Returns the header table and the outliers.
+    '''
+    table = scan_products(data_dir, workers=workers)
+    outliers = find_outliers(table)
+    plot_extents(data_dir, table=table, outliers=outliers)
+    print(f'{len(table)} pairs scanned, {len(outliers)} outliers')
+    for pair, reason in outliers.items():
+        print(f'  {pair}: {reason}')
+    return table, outliers
+
+
 def snap(window):
     """ Handle rasterio's floating point precision (sub pixel) windows """
     # Adding the offset differences to the dimensions will handle case where width/heights can 1 pixel too small
@@ -138,48 +446,63 @@ def snap(window):
 
 
 def expand_extent(raster, extent, fill_value=None):
+    '''
+    Read the window of a raster covering extent, filling any part outside 
+    the raster, and return the data and the window transform
+    '''
     window = snap(windows.from_bounds(*extent, raster.transform))
     data = raster.read(window=window, boundless=True, fill_value=fill_value)
     return data, windows.transform(window, raster.transform)
 
 
-def saveraster_with_transform(data,fname,in_transform, transform,crs='',r_crs='',drivername='GTiff',epsg='',datatype='float32',bands=1, dst_height=None,dst_width=None, nodata=0.):
+WARP_PLANS = {}
 
-    # get default file size
-    if dst_height is None:
-        dst_height,dst_width = data.shape
 
-    # data_new=np.reshape(data,(bands,data.shape[0],data.shape[1]))
-    if crs !='':
-        try:
-            crs = rasterio.crs.CRS.from_proj4(crs)
-        except TypeError:
-            crs = crs
-    elif epsg !='':
-        crs=rasterio.crs.CRS.from_epsg(epsg)
-    else:
-        crs = rasterio.crs.CRS.from_epsg('4326')
-
-    with rasterio.open(
-            fname,'w',
-            driver=drivername,
-            height=dst_height,
-            width=dst_width,
-            count=bands,
-            dtype=datatype,
-            crs=crs,
-            transform=transform
-        ) as dst:
-        reproject(
-            source=data,
-            destination=rasterio.band(dst, 1),
-            src_transform=in_transform,
-            src_crs=crs,
-            dst_transform=transform,
-            dst_crs=r_crs,
-            resampling=Resampling.nearest, # Or other resampling method if needed
-        )
-        #dst.write(np.array(data,datatype),bands)
+def get_warp_plan(src, param_dict):
+    '''
+    Return the warp plan for an open raster: the AOI extent to read, the 
+    destination pixels inside the shapefile, and the row/col of each within 
+    the extent window. 
+    HyP3 layers of a frame share a grid, so plans are cached by the source 
+    CRS, transform and shape and the AOI/destination grid (params_signature) 
+    and computed only once per grid.
+    '''
+    dst_shape = (param_dict['height'], param_dict['width'])
+    key = (src.crs.to_wkt(), tuple(src.transform), src.shape, params_signature(param_dict))
+    if key in WARP_PLANS:
+        return WARP_PLANS[key]
+
+    # AOI mask on the destination grid and the destination pixel centers
+    aoi = geometry_mask(param_dict['proj']['geometry'], out_shape=dst_shape, transform=param_dict['transform'], invert=True)
+    dst_rows, dst_cols = np.nonzero(aoi)
+    xs, ys = param_dict['transform'] * (dst_cols + 0.5, dst_rows + 0.5)
+    if src.crs != param_dict['crs']:
+        xs, ys = transform(param_dict['crs'], src.crs, xs, ys)
+        xs, ys = np.asarray(xs), np.asarray(ys)
+
+    # source window covering the AOI; parts outside the frame are read as fill
+    extent = param_dict['bounds']
+    if src.crs != param_dict['crs']:
+        extent = transform_bounds(param_dict['crs'], src.crs, *extent)
+    window = snap(windows.from_bounds(*extent, src.transform))
+
+    # nearest source pixel of each destination pixel
+    cols, rows = ~src.transform * (xs, ys)
+    rows, cols = np.floor(rows).astype(int), np.floor(cols).astype(int)
+    inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+    if not inside.any():
+        raise ValueError('Input shapes do not overlap raster.')
+    valid = np.zeros(dst_shape, dtype=bool)
+    valid[dst_rows, dst_cols] = True
+
+    plan = {
+        'extent': extent,
+        'valid': valid,
+        'rows': np.clip(rows - window.row_off, 0, window.height - 1),
+        'cols': np.clip(cols - window.col_off, 0, window.width - 1),
+    }
+    WARP_PLANS[key] = plan
+    return plan
 
 
 def transform_with_shapefile(raster, param_dict):
@@ -194,26 +517,92 @@ def transform_with_shapefile(raster, param_dict):
         # if something other than a raster name is passed, just skip it
         return
 
-    try:
-        with rasterio.open(raster) as r_int:
-            int_mask, out_transform = mask(r_int, param_dict['proj']['geometry'], crop=True)
-            r_crs = r_int.crs
-            in_transform = r_int.transform
-
-        # Create the new file
-        saveraster_with_transform(
-            np.squeeze(int_mask), 
-            fname_stem+'_int.tif', 
-            in_transform,
-            param_dict['transform'],
+    out = clip_raster(raster, param_dict)
+
+    # Create the new file
+    with rasterio.open(
+            fname_stem+'_int.tif','w',
+            driver='GTiff',
+            height=param_dict['height'],
+            width=param_dict['width'],
+            count=1,
+            dtype='float32',
             crs=param_dict['crs'],
-            r_crs=r_crs,
-            dst_width=param_dict['width'],
-            dst_height=param_dict['height'],
-        )
-    except ValueError:
-        # if the raster does not overlap, just skip it
-        return
+            transform=param_dict['transform']
+        ) as dst:
+        dst.write(out, 1)
+
+
+def clip_raster(raster, param_dict):
+    '''
+    Clip a raster to the shapefile on the destination grid and return it
+    '''
+    # a raster that does not overlap the shapefile raises a ValueError, which 
+    # is reported by process_pair
+    with rasterio.open(raster) as r_int:
+        plan = get_warp_plan(r_int, param_dict)
+        data, _ = expand_extent(r_int, plan['extent'], fill_value=0)
+
+    data = data[0]
+
+    out = np.zeros(plan['valid'].shape, dtype='float32')
+    out[plan['valid']] = data[plan['rows'], plan['cols']]
+    return out
+
+
+def process_pair(layers, param_dict, stack=False):
+    '''
+    Clip every layer of one HyP3 pair to the shapefile. Returns a list of 
+    (file, error message) for the layers that failed and, if stack is True, 
+    a dict of the clipped arrays by layer instead of writing _int.tif files.
+    '''
+    failures = []
+    arrays = {}
+    for layer in HYP3_LAYERS:
+        if layer not in layers:
+            continue
+        try:
+            if stack:
+                arrays[layer] = clip_raster(layers[layer], param_dict)
+            else:
+                transform_with_shapefile(layers[layer], param_dict)
+        except Exception as e:
+            failures.append((layers[layer], '{}: {}'.format(type(e).__name__, e)))
+    return failures, arrays
+
+
+def create_stack(stack_file, keys, param_dict, chunk_size=256, pair_chunk=32):
+    '''
+    Create an HDF5 data cube with one (pairs, rows, cols) dataset per HyP3 
+    layer, chunked so that a spatial block of pair_chunk pairs is one read. 
+    run_resampling buffers pair_chunk pairs and writes them together, so each 
+    chunk is compressed only once.
+    '''
+    shape = (len(keys), param_dict['height'], param_dict['width'])
+    chunks = (min(pair_chunk, shape[0]), min(chunk_size, shape[1]), min(chunk_size, shape[2]))
+    with h5py.File(stack_file, 'w') as f:
+        for layer in HYP3_LAYERS:
+            f.create_dataset(layer, shape=shape, dtype='float32', chunks=chunks,
+                             compression='gzip', shuffle=True, fillvalue=np.nan)
+        f['pairs'] = np.array([key.split('_')[:2] for key in keys], dtype='S')
+        f['product_ids'] = np.array([key.split('_')[2] for key in keys], dtype='S')
+        f.attrs['crs'] = param_dict['crs'].to_wkt()
+        f.attrs['transform'] = tuple(param_dict['transform'])[:6]
+
+
+def write_to_stack(stack, k0, group):
+    '''
+    Write the clipped layers of pairs k0, k0+1, ... (a list of dicts by 
+    layer) into an open stack created by create_stack, one write per layer
+    '''
+    for layer in HYP3_LAYERS:
+        if not any(layer in arrays for arrays in group):
+            continue
+        block = np.full((len(group),) + stack[layer].shape[1:], np.nan, dtype='float32')
+        for i, arrays in enumerate(group):
+            if layer in arrays:
+                block[i] = arrays[layer]
+        stack[layer][k0:k0 + len(group)] = block
 
 
 def tranform_all_files(shape_file, in_dir=os.getcwd(), out_dir=os.getcwd()):
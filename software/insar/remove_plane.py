@@ -1,8 +1,11 @@
+import argparse
 import rasterio
 
 import numpy as np
 import matplotlib.pyplot as plt
 
+from rasterio.windows import Window
+
 
 def read_raster(filename='velocity.tif'):
     '''
@@ -25,6 +28,7 @@ def remove_planar_trend(vel, X, Y):
     '''
     Remove a planar trend from the velocity data.
     '''
+    big_flag = False
     if np.abs(X.max()) > 1e4:
         big_flag = True
         X = X/1000. # scale X,Y for better numerical stability
@@ -52,6 +56,99 @@ Write the detrended velocity data to a new raster file.
             dst.write(vel, 1)
 
 
+def ramp_design(X, Y, order=1):
+    '''
+    Return the design matrix of a plane (order=1) or quadratic ramp (order=2) 
+    for flattened coordinate arrays
+    '''
+    cols = [np.ones(len(X)), X, Y]
+    if order == 2:
+        cols += [X * X, X * Y, Y * Y]
+    return np.stack(cols, axis=-1)
+
+
+def block_coords(trans, window, center, scale):
+    '''
+    Return normalized X (1 x width) and Y (height x 1) coordinates of the 
+    pixels in a window, generated from the affine transform
+    '''
+    cols = np.arange(window.col_off, window.col_off + window.width)
+    rows = np.arange(window.row_off, window.row_off + window.height)
+    x = (trans[2] + trans[0] * cols - center[0]) / scale
+    y = (trans[5] + trans[4] * rows - center[1]) / scale
+    return x[np.newaxis, :], y[:, np.newaxis]
+
+
+def row_windows(f, block_size):
+    for row in range(0, f.height, block_size):
+        yield Window(0, row, f.width, min(block_size, f.height - row))
+
+
+def read_block(f, window):
+    '''Read a window as float64 with nodata and NaN pixels set to NaN'''
+    vel = f.read(1, window=window, masked=True).astype(float)
+    return vel.filled(np.nan)
+
+
+def fit_ramp(filename='velocity.tif', order=1, block_size=128):
+    '''
+    Fit a planar (order=1) or quadratic (order=2) ramp to a raster without 
+    loading it, by accumulating the normal equations one block of rows at a 
+    time. Coordinates are centred on the raster and scaled by its half-extent 
+    for numerical stability; the returned coefficients apply to those 
+    normalized coordinates.
+    '''
+    with rasterio.open(filename, 'r') as f:
+        trans = f.transform
+        center = (trans[2] + trans[0] * f.width / 2, trans[5] + trans[4] * f.height / 2)
+        scale = max(abs(trans[0]) * f.width, abs(trans[4]) * f.height) / 2
+        nparams = 3 if order == 1 else 6
+        GtG = np.zeros((nparams, nparams))
+        Gtd = np.zeros(nparams)
+        for window in row_windows(f, block_size):
+            vel = read_block(f, window)
+            x, y = block_coords(trans, window, center, scale)
+            mask = ~np.isnan(vel)
+            X, Y = np.broadcast_arrays(x, y)
+            G = ramp_design(X[mask], Y[mask], order)
+            GtG += G.T @ G
+            Gtd += G.T @ vel[mask]
+
+    mhat = np.linalg.solve(GtG, Gtd)
+    return mhat, center, scale
+
+
+def remove_ramp(mhat, center, scale, old_raster='velocity.tif', new_raster='velocity_noplane.tif', block_size=128):
+    '''
+    Subtract a ramp fitted by fit_ramp from a raster in a windowed pass and 
+    write the result. Returns the mean and standard deviation of the 
+    original and detrended data.
+    '''
+    order = 1 if len(mhat) == 3 else 2
+    sums = np.zeros((2, 2))
+    n = 0
+    with rasterio.open(old_raster, 'r') as src:
+        trans = src.transform
+        fill = np.nan if src.nodata is None else src.nodata
+        with rasterio.open(new_raster, 'w', **src.meta) as dst:
+            for window in row_windows(src, block_size):
+                vel = read_block(src, window)
+                x, y = block_coords(trans, window, center, scale)
+                X, Y = np.broadcast_arrays(x, y)
+                ramp = (ramp_design(X.ravel(), Y.ravel(), order) @ mhat).reshape(vel.shape)
+                detrended = vel - ramp
+                mask = ~np.isnan(vel)
+                n += mask.sum()
+                for k, v in enumerate([vel[mask], detrended[mask]]):
+                    sums[k] += v.sum(), (v * v).sum()
+                detrended[~mask] = fill
+                dst.write(detrended.astype(src.dtypes[0]), 1, window=window)
+
+    mean = sums[:, 0] / n
+    std = np.sqrt(sums[:, 1] / n - mean ** 2)
+    return mean, std
+
+
 def plot_velocity(raster, title='Detrended Velocity'):
     '''
     Plot the detrended velocity data.
@@ -67,13 +164,22 @@ def plot_velocity(raster, title='Detrended Velocity'):
     plt.show()
 
 
+def cmdLineParse():
+    parser = argparse.ArgumentParser(description='Remove a planar or quadratic ramp from a velocity raster')
+    parser.add_argument('-i', '--input', type=str, default='velocity.tif', help='input raster (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=str, default='velocity_noplane.tif', help='output raster (default: %(default)s)')
+    parser.add_argument('--order', type=int, default=1, choices=[1, 2], help='1 for a plane, 2 for a quadratic ramp (default: %(default)s)')
+    parser.add_argument('-b', '--block-size', dest='blockSize', type=int, default=128, help='number of rows read at a time (default: %(default)s)')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    vel, X, Y = read_raster()
-    vel_detrended, mhat = remove_planar_trend(vel, X, Y)
-    write_vel_to_raster(vel_detrended)
-    print(f'Detrended velocity written to velocity_noplane.tif with parameters: {mhat}')
-    print('Mean and standard deviation of original velocity:{:.5f}, {:.5f} m/yr'.format(np.mean(vel), np.std(vel)))
-    print('Mean and standard deviation of detrended velocity:{:.5f}, {:.5f} m/yr'.format(np.mean(vel_detrended), np.std(vel_detrended)))
+    inps = cmdLineParse()
+    mhat, center, scale = fit_ramp(inps.input, order=inps.order, block_size=inps.blockSize)
+    mean, std = remove_ramp(mhat, center, scale, inps.input, inps.output, block_size=inps.blockSize)
+    print(f'Detrended velocity written to {inps.output} with parameters: {mhat}')
+    print('Mean and standard deviation of original velocity:{:.5f}, {:.5f} m/yr'.format(mean[0], std[0]))
+    print('Mean and standard deviation of detrended velocity:{:.5f}, {:.5f} m/yr'.format(mean[1], std[1]))
     print('Done.')
     # TODO: add plotting functionality
     # print('To visualize the results, use the following command:')